@@ -0,0 +1,28 @@
+"""add jitter seconds
+
+Revision ID: b7d1e4a9c3f2
+Revises: 02999f6f9787
+Create Date: 2026-10-18 07:10:12.184310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d1e4a9c3f2'
+down_revision = '02999f6f9787'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('posts', sa.Column('jitter_seconds', sa.Integer(), nullable=True))
+    op.add_column('bot_tokens', sa.Column('jitter_seconds', sa.Integer(), nullable=True))
+    pass
+
+
+def downgrade():
+    op.drop_column('bot_tokens', 'jitter_seconds')
+    op.drop_column('posts', 'jitter_seconds')
+    pass
@@ -0,0 +1,42 @@
+"""add outbox
+
+Revision ID: c4e8f2a1d6b7
+Revises: b7d1e4a9c3f2
+Create Date: 2026-10-18 09:02:41.530127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8f2a1d6b7'
+down_revision = 'b7d1e4a9c3f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'outbox',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('post_id', sa.Integer, sa.ForeignKey('posts.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('bot_token_id', sa.Integer, sa.ForeignKey('bot_tokens.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('payload', sa.String, nullable=False),
+        sa.Column('idempotency_key', sa.String, nullable=False, unique=True),
+        sa.Column('status', sa.String, server_default='pending', nullable=False),
+        sa.Column('attempts', sa.Integer, server_default='0', nullable=False),
+        sa.Column('next_attempt', postgresql.TIMESTAMP(timezone=False), server_default=sa.text('now()'), nullable=False),
+        sa.Column('last_error', sa.String, nullable=True),
+        sa.Column('created_at', postgresql.TIMESTAMP(timezone=False), server_default=sa.text('now()'), nullable=False),
+    )
+    # The drain loop only looks at pending rows that are due
+    op.create_index('ix_outbox_pending_next_attempt', 'outbox', ['next_attempt'], postgresql_where=sa.text("status = 'pending'"))
+    pass
+
+
+def downgrade():
+    op.drop_index('ix_outbox_pending_next_attempt', table_name='outbox')
+    op.drop_table('outbox')
+    pass
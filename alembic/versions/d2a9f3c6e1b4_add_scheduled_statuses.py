@@ -0,0 +1,36 @@
+"""add scheduled statuses
+
+Revision ID: d2a9f3c6e1b4
+Revises: c4e8f2a1d6b7
+Create Date: 2026-10-18 11:24:05.861342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'd2a9f3c6e1b4'
+down_revision = 'c4e8f2a1d6b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'scheduled_statuses',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('post_id', sa.Integer, sa.ForeignKey('posts.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('bot_token_id', sa.Integer, sa.ForeignKey('bot_tokens.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('scheduled_at', postgresql.TIMESTAMP(timezone=False), nullable=False),
+        sa.Column('scheduled_status_id', sa.String, nullable=True),
+        sa.Column('created_at', postgresql.TIMESTAMP(timezone=False), server_default=sa.text('now()'), nullable=False),
+        sa.UniqueConstraint('post_id', 'scheduled_at'),
+    )
+    pass
+
+
+def downgrade():
+    op.drop_table('scheduled_statuses')
+    pass
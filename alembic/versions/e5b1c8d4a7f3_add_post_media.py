@@ -0,0 +1,35 @@
+"""add post media
+
+Revision ID: e5b1c8d4a7f3
+Revises: d2a9f3c6e1b4
+Create Date: 2026-10-18 12:40:17.302518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b1c8d4a7f3'
+down_revision = 'd2a9f3c6e1b4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'post_media',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('post_id', sa.Integer, sa.ForeignKey('posts.id', ondelete='CASCADE'), nullable=False, index=True),
+        sa.Column('position', sa.Integer, nullable=False),
+        sa.Column('media_path', sa.String, nullable=False),
+        sa.Column('description', sa.String, nullable=True),
+        sa.Column('focus_x', sa.Float, nullable=True),
+        sa.Column('focus_y', sa.Float, nullable=True),
+    )
+    pass
+
+
+def downgrade():
+    op.drop_table('post_media')
+    pass
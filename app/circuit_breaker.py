@@ -0,0 +1,141 @@
+from .config import settings
+
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+import asyncio
+import aiohttp
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+'''
+Circuit breakers and bulkheads for outbound calls
+
+Every destination (the Mastodon instance, each host used by {{dynamic: ...}}) gets a breaker. After
+circuit_failure_threshold failures in a row (connection errors, timeouts, 5xx) the breaker opens and calls fail fast
+with CircuitOpen for circuit_reset_timeout seconds. Then one probe call is let through (half open): success closes
+the breaker, failure opens it again. A breaker can also carry a bulkhead, a cap on concurrent calls to its destination,
+so one slow host cannot take every pooled connection.
+'''
+
+class CircuitOpen(Exception):
+    def __init__(self, name: str, retry_at: datetime):
+        super().__init__(f"Circuit {name} is open until {retry_at}")
+        self.name = name
+        self.retry_at = retry_at
+
+
+class Call:
+    # Set failed for responses that count as a failure of the destination, e.g. 5xx
+    def __init__(self):
+        self.failed = False
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, max_concurrency: int = None):
+        self.name = name
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.max_concurrency = max_concurrency
+        self.bulkhead = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        self.stats = {
+            "calls": 0,
+            "failures": 0,
+            "rejected": 0,
+            "opened": 0,
+        }
+
+    @property
+    def retry_at(self):
+        if self.opened_at == None:
+            return None
+        return self.opened_at + timedelta(seconds=settings.circuit_reset_timeout)
+
+    def before_call(self):
+        # Raise CircuitOpen unless the call may go ahead
+        if self.state == "open" and datetime.now() >= self.retry_at:
+            self.state = "half_open"
+            logger.info(f"CircuitBreaker: {self.name} half open, probing")
+        if self.state == "open" or (self.state == "half_open" and self.probing):
+            self.stats["rejected"] += 1
+            raise CircuitOpen(self.name, self.retry_at or datetime.now())
+        if self.state == "half_open":
+            self.probing = True
+        self.stats["calls"] += 1
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info(f"CircuitBreaker: {self.name} closed")
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.stats["failures"] += 1
+        self.probing = False
+        if self.state == "half_open" or self.failures >= settings.circuit_failure_threshold:
+            if self.state != "open":
+                self.stats["opened"] += 1
+                logger.warning(f"CircuitBreaker: {self.name} open after {self.failures} failure(s)")
+            self.state = "open"
+            self.opened_at = datetime.now()
+
+    def status(self):
+        return {
+            "name": self.name,
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "retry_at": self.retry_at,
+            "max_concurrency": self.max_concurrency,
+            **self.stats,
+        }
+
+
+breakers = {}
+
+def get_breaker(name: str, max_concurrency: int = None):
+    if name not in breakers:
+        breakers[name] = CircuitBreaker(name, max_concurrency)
+    return breakers[name]
+
+@asynccontextmanager
+async def guard(name: str, max_concurrency: int = None):
+    # async with guard("mastodon") as call: ... set call.failed = True for failure responses.
+    # Connection errors and timeouts inside the block count as failures and are re-raised.
+    breaker = get_breaker(name, max_concurrency)
+    breaker.before_call()
+    call = Call()
+    try:
+        if breaker.bulkhead != None:
+            await breaker.bulkhead.acquire()
+        try:
+            yield call
+        finally:
+            if breaker.bulkhead != None:
+                breaker.bulkhead.release()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        breaker.record_failure()
+        raise
+    except Exception:
+        # Raised by the caller after it got a response
+        if call.failed:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    except BaseException:
+        # Cancelled, the destination was not at fault
+        breaker.probing = False
+        raise
+    if call.failed:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+def circuits():
+    return [breaker.status() for breaker in breakers.values()]
@@ -1,14 +1,23 @@
 from .config import settings
 from .database import get_db
-from . import models, schemas, clock_post_commands
+from . import database, models, schemas, clock_post_commands, http_client, rate_limit, circuit_breaker
+from .schedule_queue import ScheduleQueue, ScheduleEntry
+from .dispatcher import Dispatcher
+from .cron import compile_cron
+from .media_cache import MediaCache, Attachment
 
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple, Optional
 from fastapi import Depends
-import asyncio
+from sqlalchemy import func, select, update, insert, delete, values, column, exists, or_, Integer
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.sql.sqltypes import TIMESTAMP
 import aiohttp
+import asyncio
+import time
+import uuid
 import json
-import croniter
-import magic
+import os
 
 import logging
 
@@ -18,6 +27,59 @@ logger = logging.getLogger(__name__)
 Main clock-bot logic
 '''
 
+class PreparedStatus(NamedTuple):
+    post_id: int
+    next_run: Optional[datetime]
+    # post_source() of the post it was rendered from
+    source: tuple
+    bot_token: str
+    # JSON body for POST /api/v1/statuses
+    data: str
+    # (media_key, media_id) of every attachment
+    media: list
+    rendered_at: float
+
+# Scheduler index of published posts keyed on next_run
+schedule_queue = ScheduleQueue()
+# Runs due posts concurrently with global and per bot limits
+dispatcher = Dispatcher(settings.max_concurrent_posts, settings.max_concurrent_posts_per_bot)
+# Renders upcoming statuses
+prerender_dispatcher = Dispatcher(settings.max_concurrent_posts, settings.max_concurrent_posts_per_bot)
+# Runs outbox retries, kept apart so retries do not take slots from on-time posts
+outbox_dispatcher = Dispatcher(settings.outbox_concurrency, settings.max_concurrent_posts_per_bot)
+# Set to wake the scheduler early when posts change, changed post ids are collected in changed_post_ids
+schedule_changed = asyncio.Event()
+changed_post_ids = set()
+resync_needed = False
+scheduler_running = False
+# Set when the NOTIFY listener first connects, clock_bot_main waits for it before loading the schedule
+listener_connected = asyncio.Event()
+schedule_loaded = False
+# Write-behind buffers for next_run updates and post_log inserts, flushed together by flush_writes
+pending_next_runs = {}
+pending_post_logs = []
+flush_requested = asyncio.Event()
+# (post_id, next_run) of slots Mastodon publishes itself through scheduled_at, see sync_scheduled_statuses
+offloaded_slots = set()
+# bot_token_id -> time until which nothing more is scheduled on Mastodon for the bot, after Mastodon refused a
+# status because the account has too many scheduled statuses
+scheduling_refused = {}
+# Statuses rendered ahead of their slot by prerender_main, keyed by (post_id, next_run)
+prepared_statuses = {}
+prerender_stats = {"rendered": 0, "hits": 0, "misses": 0}
+# Processed media_ids not attached to a status yet, keyed by file content and bot
+uploaded_media = MediaCache()
+# Uploads started ahead of time by prefetch_media, keyed like uploaded_media, and the next_run they were started for
+media_uploads = {}
+prefetched_media = {}
+# Missed runs waiting to be posted by catch_up_main
+catch_up_queue = asyncio.Queue()
+# Only the process holding database.PREPARE_LOCK_ID uploads media and renders statuses ahead of their slot,
+# so several scheduler processes do not all do it for every post
+preparing = False
+# Filled in by prepare_schedule
+startup_stats = {}
+
 def quiet_mode():
     if settings.quiet == True:
         logger.warning("quiet_mode: Quiet mode is enabled")
@@ -27,51 +89,299 @@ def quiet_mode():
 
 
 async def check_scheduled_posts():
-    with get_db() as db:
-        try:
-            logger.debug("check_scheduled_posts: Checking scheduled posts")
-            scheduled_posts = await get_scheduled_posts(db)
-            for post in scheduled_posts:
-                if await check_next_run(post):
-                    await post_status(post)
-                    
-        except Exception as e:
-            logger.error(f"check_scheduled_posts: {e}")
+    try:
+        logger.debug("check_scheduled_posts: Checking scheduled posts")
+        await schedule_unscheduled_posts()
+        due_entries = schedule_queue.pop_due(datetime.now())
+        if not due_entries:
+            return
+        logger.debug(f"check_scheduled_posts: {len(due_entries)} post(s) due")
+        due_posts, catch_up_posts = await claim_due_posts(due_entries)
+        for post in catch_up_posts:
+            catch_up_queue.put_nowait(post)
+        # Posts run in the background under the dispatcher's limits, a slow post (media processing, rate limit
+        # waits) must not hold back the posts due after it
+        for post in due_posts:
+            dispatcher.submit(post, post_status)
+    except Exception as e:
+        logger.error(f"check_scheduled_posts: {e}")
 
 async def get_scheduled_posts(db):
+    # Load compact schedule records for all published posts, not full ORM objects
     try:
-        scheduled_posts = db.query(models.Post).filter(models.Post.published == True).all()
+        scheduled_posts = schedule_query(db).filter(models.Post.published == True).all()
         scheduled_posts_count = len(scheduled_posts)
         logger.debug(f"get_scheduled_posts: scheduled_posts_count: {scheduled_posts_count}")        
-        return scheduled_posts
+        return [schedule_entry(scheduled_post) for scheduled_post in scheduled_posts]
     except Exception as e:
         logger.error(f"get_scheduled_posts: {e}")
+        return []
+
+def schedule_query(db):
+    # Compact schedule records, the jitter window comes from the post, then its bot token
+    return db.query(models.Post.id, models.Post.next_run, models.Post.crontab_schedule, models.Post.bot_token_id, func.coalesce(models.Post.jitter_seconds, models.BotToken.jitter_seconds), or_(models.Post.media_path != None, exists().where(models.PostMedia.post_id == models.Post.id))).outerjoin(models.BotToken, models.BotToken.id == models.Post.bot_token_id)
+
+def jitter_offset(post_id: int, jitter_seconds):
+    # Deterministic offset in [0, jitter_seconds) for a post. Multiples of the golden ratio spread
+    # consecutive post ids evenly over the window, so the same post always fires at the same offset.
+    if jitter_seconds == None:
+        jitter_seconds = settings.jitter_seconds
+    if not jitter_seconds or jitter_seconds <= 0:
+        return 0.0
+    return round((post_id * 0.6180339887498949) % 1.0 * jitter_seconds, 3)
 
-async def check_next_run(post):
+def schedule_entry(scheduled_post):
+    # Build a ScheduleEntry from a (id, next_run, crontab_schedule, bot_token_id, jitter_seconds, has_media) row.
+    # A next_run still waiting in the write-behind buffer is newer than the value in the database.
+    post_id, next_run, crontab_schedule, bot_token_id, jitter_seconds, has_media = scheduled_post
+    entry = ScheduleEntry(post_id, next_run, crontab_schedule, bot_token_id, jitter_offset(post_id, jitter_seconds), bool(has_media))
+    if entry.post_id in pending_next_runs:
+        entry = entry._replace(next_run=pending_next_runs[entry.post_id])
+    return entry
+
+async def claim_due_posts(due_entries):
+    # Claim due posts so that only one clock-bot process posts each slot, even with several workers or containers.
+    # Due rows are locked with SELECT ... FOR UPDATE SKIP LOCKED and their next_run is advanced in the same
+    # transaction, a post is claimed only if its next_run in the database is not ahead of this process' entry.
+    # Returns (on_time_posts, catch_up_posts), missed runs are handled according to settings.missed_run_policy.
+    entries = {entry.post_id: entry for entry in due_entries}
     try:
-        current_time=datetime.now()
-        if post.next_run == None:
-            logger.debug(f"check_next_run: Post {post.id} next run is Null. Updating next run")
-            await update_next_run(post)
-            return False
-        elif post.next_run < current_time:
-            logger.debug(f"check_next_run: Post {post.id} next run is less than current_time.  Posting status")
-            return True
-        else:
-            logger.debug(f"check_next_run: Post {post.id} next run is greater than current_time.  Not posting status")
-            return False
+        current_time = datetime.now()
+        with get_db() as db:
+            due_posts = db.query(models.Post).filter(models.Post.id.in_(list(entries)), models.Post.published == True).order_by(models.Post.next_run, models.Post.id).limit(settings.scheduler_claim_batch).with_for_update(skip_locked=True).all()
+            # Keep the loaded attributes available after commit
+            db.expunge_all()
+            claimed = []
+            catch_up = []
+            next_runs = []
+            for post in due_posts:
+                entry = entries.pop(post.id)
+                if post.next_run != None and entry.next_run != None and post.next_run > entry.next_run:
+                    # Another process already posted this slot
+                    logger.debug(f"claim_due_posts: Post {post.id} slot {entry.next_run} was claimed elsewhere")
+                    schedule_queue.push(entry._replace(next_run=post.next_run, crontab_schedule=post.crontab_schedule))
+                    continue
+                try:
+                    next_run, action = plan_next_run(post, current_time, entry.jitter)
+                except ValueError as e:
+                    logger.error(f"claim_due_posts: Post {post.id} crontab_schedule {post.crontab_schedule} is not valid: {e}")
+                    continue
+                next_runs.append((post.id, next_run))
+                if action == "post":
+                    claimed.append(post)
+                elif action == "catch_up":
+                    catch_up.append(post)
+                else:
+                    logger.info(f"claim_due_posts: Post {post.id} missed run {post.next_run} skipped")
+                pending_next_runs.pop(post.id, None)
+                schedule_queue.push(entry._replace(next_run=next_run, crontab_schedule=post.crontab_schedule, bot_token_id=post.bot_token_id))
+            write_next_runs(db, next_runs)
+            db.commit()
+        if entries:
+            if len(due_posts) < settings.scheduler_claim_batch:
+                # Locked by another process, deleted or unpublished, reload them from the database
+                changed_post_ids.update(entries)
+                schedule_changed.set()
+            else:
+                # Over the claim batch, leave them due for the next pass
+                for entry in entries.values():
+                    schedule_queue.push(entry)
+        logger.debug(f"claim_due_posts: Claimed {len(claimed)} on time and {len(catch_up)} missed of {len(due_entries)} due post(s)")
+        return claimed, catch_up
+    except Exception as e:
+        # Put the entries back so they are retried
+        for entry in due_entries:
+            schedule_queue.push(entry)
+        logger.error(f"claim_due_posts: {e}")
+        return [], []
+
+def plan_next_run(post, current_time: datetime, jitter: float = 0.0):
+    # Returns (next_run, action) for a claimed post, action is "post", "catch_up" or "skip".
+    # A run that should have fired more than missed_run_grace seconds ago is a missed run (e.g. after downtime)
+    # and is skipped, posted once (coalesce) or replayed slot by slot depending on missed_run_policy.
+    slot = post.next_run
+    if slot == None or (current_time - slot).total_seconds() - jitter <= settings.missed_run_grace:
+        return calculate_next_run(post, current_time), "post"
+    schedule = compile_cron(post.crontab_schedule)
+    if settings.missed_run_policy == "skip":
+        return schedule.next_after(current_time), "skip"
+    if settings.missed_run_policy == "replay":
+        missed = [slot] + [fire_time for fire_time in schedule.between(slot, current_time) if fire_time > slot]
+        replay_limit = max(1, settings.missed_run_replay_limit)
+        if len(missed) > replay_limit:
+            # Only the most recent missed runs are replayed
+            return missed[len(missed) - replay_limit], "skip"
+        if len(missed) > 1:
+            return missed[1], "catch_up"
+    return schedule.next_after(current_time), "catch_up"
+
+async def catch_up_main():
+    # Drain missed runs at catch_up_rate posts per second next to the on-time posts
+    while True:
+        try:
+            post = await catch_up_queue.get()
+            if (post.id, post.next_run) in offloaded_slots:
+                logger.info(f"catch_up_main: Missed run {post.next_run} of post {post.id} was published by Mastodon")
+                continue
+            logger.info(f"catch_up_main: Posting missed run {post.next_run} of post {post.id}, {catch_up_queue.qsize()} left")
+            dispatcher.submit(post, post_status)
+        except Exception as e:
+            logger.error(f"catch_up_main: {e}")
+        await asyncio.sleep(1 / settings.catch_up_rate)
+
+async def load_schedule():
+    # Fill the scheduler queue with every published post as stored in the database
+    global offloaded_slots
+    try:
+        with get_db() as db:
+            scheduled_posts = await get_scheduled_posts(db)
+            offloaded_slots = load_offloaded_slots(db)
+        schedule_queue.clear()
+        for entry in scheduled_posts:
+            schedule_queue.push(entry)
+        logger.info(f"load_schedule: {len(schedule_queue)} post(s) scheduled")
     except Exception as e:
-        logger.error(f"check_next_run: {e}")
+        logger.error(f"load_schedule: {e}")
+
+async def schedule_unscheduled_posts():
+    # Calculate next_run for posts added with a Null next_run
+    for entry in schedule_queue.unscheduled():
+        logger.debug(f"schedule_unscheduled_posts: Post {entry.post_id} next run is Null. Updating next run")
+        await update_next_run(entry)
 
-async def update_next_run(post):
+async def apply_schedule_changes():
+    # Reload the compact records of posts that changed since the last check
+    global resync_needed
+    if resync_needed:
+        resync_needed = False
+        changed_post_ids.clear()
+        await load_schedule()
+        return
+    if not changed_post_ids:
+        return
+    post_ids = list(changed_post_ids)
+    changed_post_ids.clear()
     try:
-        schedule = croniter.croniter(post.crontab_schedule)
-        next_run = schedule.get_next(datetime)
         with get_db() as db:
-            db.query(models.Post).filter(models.Post.id == post.id).update({"next_run": next_run})
-            db.commit()
-            logger.debug(f"update_next_run: Post {post.id} next run updated to {next_run}")
+            scheduled_posts = schedule_query(db).filter(models.Post.id.in_(post_ids), models.Post.published == True).all()
+            # Scheduled statuses of edited posts are cancelled by the posts router
+            offloaded = load_offloaded_slots(db, post_ids)
+        offloaded_slots.difference_update([slot for slot in offloaded_slots if slot[0] in post_ids])
+        offloaded_slots.update(offloaded)
+        discard_prepared_statuses(post_ids)
+        for post_id in post_ids:
+            schedule_queue.remove(post_id)
+        for scheduled_post in scheduled_posts:
+            schedule_queue.push(schedule_entry(scheduled_post))
+        logger.debug(f"apply_schedule_changes: Reloaded {len(post_ids)} post(s), {len(scheduled_posts)} scheduled")
     except Exception as e:
+        changed_post_ids.update(post_ids)
+        logger.error(f"apply_schedule_changes: {e}")
+
+def handle_notification(payload: str):
+    # Payloads are "<kind>:<id>", e.g. "post:12"
+    global resync_needed
+    kind, _, object_id = payload.partition(":")
+    if kind == "post":
+        if object_id.isdigit():
+            changed_post_ids.add(int(object_id))
+        else:
+            resync_needed = True
+        schedule_changed.set()
+    elif kind == "list":
+        clock_post_commands.list_contents.invalidate(int(object_id) if object_id.isdigit() else None)
+
+def handle_listen_connect():
+    # Notifications may have been missed before the listener (re)connected, e.g. lists loaded while it was down.
+    # The schedule is only reloaded if it was loaded before this connection, not on the first connect at startup.
+    global resync_needed
+    clock_post_commands.list_contents.invalidate()
+    listener_connected.set()
+    if schedule_loaded:
+        resync_needed = True
+        schedule_changed.set()
+
+def handle_prepare_lock(held: bool):
+    global preparing
+    preparing = held
+    logger.info(f"handle_prepare_lock: {'Preparing' if held else 'Not preparing'} posts ahead of their slot")
+
+def notify_schedule_change(db, post_id):
+    # Called by the posts router after a post is created, updated or deleted, and with post_id "*" by the bot
+    # router after a bot token changed, which reloads every post.
+    # Wakes the scheduler in this process and other processes through Postgres NOTIFY.
+    if scheduler_running:
+        handle_notification(f"post:{post_id}")
+    try:
+        database.notify(db, f"post:{post_id}")
+    except Exception as e:
+        logger.error(f"notify_schedule_change: {e}")
+
+def notify_list_change(db, list_id):
+    # Called by the lists router after a list or its items are created, updated or deleted.
+    # Drops the list from the list index in this process and other processes through Postgres NOTIFY.
+    handle_notification(f"list:{list_id}")
+    try:
+        database.notify(db, f"list:{list_id}")
+    except Exception as e:
+        logger.error(f"notify_list_change: {e}")
+
+async def wait_for_next_run():
+    # Sleep until the earliest next_run or until the schedule changes
+    next_run = schedule_queue.peek_next_run()
+    timeout = settings.scheduler_max_sleep
+    if schedule_queue.unscheduled():
+        timeout = 0
+    elif next_run != None:
+        timeout = min(timeout, max((next_run - datetime.now()).total_seconds(), 0))
+    logger.debug(f"wait_for_next_run: Sleeping for up to {timeout:.3f}s")
+    try:
+        await asyncio.wait_for(schedule_changed.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        pass
+
+def scheduler_status():
+    return {
+        "scheduled_posts": len(schedule_queue),
+        "next_run": schedule_queue.peek_next_run(),
+        "dispatcher": dispatcher.stats,
+        "startup": startup_stats,
+        "missed_run_policy": settings.missed_run_policy,
+        "catch_up_queued": catch_up_queue.qsize(),
+        "preparing": preparing,
+        "outbox": outbox_status(),
+        "outbox_dispatcher": outbox_dispatcher.stats,
+        "media_cache": uploaded_media.status(),
+        "media_uploads": sum(len(tasks) for tasks in media_uploads.values()),
+        "prepared_statuses": len(prepared_statuses),
+        "prerender": prerender_stats,
+        "offloaded_slots": len(offloaded_slots),
+        "scheduling_refused": scheduling_refused,
+        "templates": clock_post_commands.compile_template.cache_info()._asdict(),
+        "dynamic_cache": clock_post_commands.dynamic_responses.status(),
+        "list_index": clock_post_commands.list_contents.status(),
+    }
+
+def calculate_next_run(post, current_time: datetime):
+    # post can be a models.Post or a ScheduleEntry
+    schedule = compile_cron(post.crontab_schedule)
+    # Step from the previous slot so next_run does not drift, unless that slot is already in the past
+    next_run = None
+    if post.next_run != None:
+        next_run = schedule.next_after(post.next_run)
+    if next_run == None or next_run <= current_time:
+        next_run = schedule.next_after(current_time)
+    return next_run
+
+async def update_next_run(entry):
+    try:
+        next_run = calculate_next_run(entry, datetime.now())
+        queue_write(next_run=(entry.post_id, next_run))
+        logger.debug(f"update_next_run: Post {entry.post_id} next run updated to {next_run}")
+        schedule_queue.push(entry._replace(next_run=next_run))
+    except Exception as e:
+        # Drop the post from the scheduler index, it is picked up again when it is edited or on restart
+        schedule_queue.remove(entry.post_id)
         logger.error(f"update_next_run: {e}")
 
 
@@ -79,84 +389,567 @@ async def update_next_run(post):
 async def post_status(post):
     try:
         logger.debug(f"post_status: Checking post {post.id} status")
-        bot_token = await get_bot_token(post.bot_token_id)
-        if post.bot_token_id == None:
-            logger.error(f"post_status: Post {post.id} bot_token_id is Null")
+        if (post.id, post.next_run) in offloaded_slots:
+            logger.debug(f"post_status: Post {post.id} slot {post.next_run} is published by Mastodon")
+            return True
+        # Use the status prepared ahead of this slot when the post has not changed since, otherwise render it now
+        prepared = take_prepared_status(post)
+        if prepared == None:
+            prepared = await render_status(post)
+        if prepared == None:
             return False
+        if quiet_mode() == True:
+            logger.warning(f"post_status: Quiet mode is enabled.  Status {post.id} not posted")
+            release_media(prepared.media)
+            # Update post_log table with post_id and last_posted
+            await update_post_log(post.id)
+            return True
         else:
-            if bot_token == None:
-                logger.error(f"post_status: Post {post.id} bot_token is Null")
+            # Store the rendered status before sending it, failed sends are retried from the outbox
+            outbox_entry = await add_to_outbox(post, prepared.data)
+            if outbox_entry == None:
+                release_media(prepared.media)
                 return False
-            else:
-                # Check for media_path and upload media if it exists
-                if post.media_path != None:
-                    logger.debug(f"post_status: Post {post.id} has media_path.  Uploading media")
-                    media_id = await upload_media(post)
-                    # add media_id to media_ids list
-                    if media_id == None:
-                        logger.error(f"post_status: Post {post.id} media_id returned Null")
-                        media_ids = None
-                    else:
-                        media_ids = [media_id]
-                        logger.debug(f"post_status: Post {post.id} media_ids: {media_ids}")
-                else:
-                    media_ids = None
-                    logger.debug(f"post_status: Post {post.id} has no media_path.  Not uploading media")
-                # Check for commands in post.content
-                post = await clock_post_commands.check_post_commands(post)                
-                # Post status
-                headers = {
-                "Authorization": f"Bearer {bot_token}",
-                "Content-Type": "application/json"
-                }
-                # Conver payload to json
-                data = json.dumps({
-                    "status": post.content,
-                    "sensitive": post.sensitive,
-                    "spoiler_text": post.spoiler_text,
-                    "visibility": post.visibility,
-                    "media_ids": media_ids
-                })
-                logger.debug(f"post_status: Post {post.id} data: {data}")
-                if quiet_mode() == True:
-                    logger.warning(f"post_status: Quiet mode is enabled.  Status {post.id} not posted")
-                    # Update post_log table with post_id and last_posted
-                    await update_post_log(post)
-                    return True
-                else:
-                    async with aiohttp.ClientSession() as session:
-                        async with session.post(f"{settings.mastodon_base_url}/api/v1/statuses", headers=headers, data=data) as response:
-                            if response.status == 200:
-                                # Update post_log table with post_id and last_posted
-                                await update_next_run(post)
-                                await update_post_log(post)
-                                logger.info(f"post_status: Status {post.id} posted successfully at {datetime.now()}")
-                                logger.debug(f"post_status: Status {post.id} response: {await response.json()}")
-                                return True
-                            else:
-                                await update_next_run(post)
-                                logger.error(f"post_status: Status {post.id} not posted.  Response status: {response.status}")
-                                logger.debug(f"post_status: Status {post.id} response: {await response.json()}")
-                                return False
+            return await deliver_status(outbox_entry, prepared.bot_token)
     except Exception as e:
         logger.error(f"post_status: {e}")
 
-async def update_post_log(post):
+def post_source(post):
+    # The columns a rendered status depends on, used to tell whether a prepared status is still current
+    return (post.content, post.sensitive, post.spoiler_text, post.visibility, tuple(post_attachments(post)), post.bot_token_id)
+
+def post_attachments(post):
+    # The post's media_path first, then its post_media rows, up to Mastodon's four attachments
+    attachments = []
+    if post.media_path:
+        attachments.append(Attachment(post.media_path))
+    for media in getattr(post, "media", None) or []:
+        focus = f"{media.focus_x},{media.focus_y}" if media.focus_x != None and media.focus_y != None else None
+        attachments.append(Attachment(media.media_path, media.description, focus))
+    return attachments[:schemas.MAX_ATTACHMENTS]
+
+async def render_status(post):
+    # Look up the bot token, upload or take media and resolve {{...}} commands. Returns a PreparedStatus or None.
+    source = post_source(post)
+    bot_token = await get_bot_token(post.bot_token_id)
+    if post.bot_token_id == None:
+        logger.error(f"render_status: Post {post.id} bot_token_id is Null")
+        return None
+    else:
+        if bot_token == None:
+            logger.error(f"render_status: Post {post.id} bot_token is Null")
+            return None
+        else:
+            # Upload or take every attachment at the same time, the status is built once all of them are ready
+            attachments = post_attachments(post)
+            media = []
+            media_ids = None
+            if attachments:
+                logger.debug(f"render_status: Post {post.id} has {len(attachments)} attachment(s).  Uploading media")
+                media = [item for item in await asyncio.gather(*[get_media(post, attachment) for attachment in attachments]) if item[1] != None]
+                if len(media) < len(attachments):
+                    # Do not post the status without some of its media, it is retried like any failed post
+                    logger.error(f"render_status: Post {post.id} {len(attachments) - len(media)} media_id(s) returned Null")
+                    release_media(media)
+                    return None
+                media_ids = [media_id for media_key, media_id in media]
+                logger.debug(f"render_status: Post {post.id} media_ids: {media_ids}")
+            else:
+                logger.debug(f"render_status: Post {post.id} has no media.  Not uploading media")
+            # Resolve {{...}} commands into a new string, post.content is left as stored
+            content = await clock_post_commands.render_template(post.content, post.id)
+            # Conver payload to json
+            data = json.dumps({
+                "status": content,
+                "sensitive": post.sensitive,
+                "spoiler_text": post.spoiler_text,
+                "visibility": post.visibility,
+                "media_ids": media_ids
+            })
+            logger.debug(f"render_status: Post {post.id} data: {data}")
+            prerender_stats["rendered"] += 1
+            return PreparedStatus(post.id, post.next_run, source, bot_token, data, media, time.monotonic())
+
+def take_prepared_status(post):
+    # Remove and return the status prepared for this post and slot if it is still current
+    prepared = prepared_statuses.pop((post.id, post.next_run), None)
+    if prepared == None:
+        prerender_stats["misses"] += 1
+        return None
+    if prepared.source != post_source(post) or time.monotonic() - prepared.rendered_at > settings.prerender_max_age:
+        release_media(prepared.media)
+        prerender_stats["misses"] += 1
+        return None
+    prerender_stats["hits"] += 1
+    return prepared
+
+def discard_prepared_statuses(post_ids):
+    # Drop prepared statuses of changed posts, their unused media goes back to the cache
+    for key in [key for key in prepared_statuses if key[0] in post_ids]:
+        prepared = prepared_statuses.pop(key)
+        release_media(prepared.media)
+
+async def prepare_status(post):
+    prepared = await render_status(post)
+    if prepared == None:
+        return
+    key = (prepared.post_id, prepared.next_run)
+    if key in prepared_statuses:
+        # Refreshed, the previous rendering's media is no longer needed
+        release_media(prepared_statuses[key].media)
+    prepared_statuses[key] = prepared
+
+async def prerender_statuses(current_time: datetime):
+    # Render posts firing within prerender_lead seconds that have no current prepared status
+    upcoming = {}
+    for entry in schedule_queue.upcoming(current_time + timedelta(seconds=settings.prerender_lead)):
+        if (entry.post_id, entry.next_run) in offloaded_slots:
+            continue
+        prepared = prepared_statuses.get((entry.post_id, entry.next_run))
+        if prepared == None or time.monotonic() - prepared.rendered_at > settings.prerender_max_age:
+            upcoming[entry.post_id] = entry
+    # Forget statuses of slots that fired without using them, e.g. skipped missed runs
+    expired = current_time - timedelta(seconds=settings.missed_run_grace + settings.prerender_lead)
+    for key in [key for key in prepared_statuses if key[1] == None or key[1] < expired]:
+        prepared = prepared_statuses.pop(key)
+        release_media(prepared.media)
+    if not upcoming:
+        return
     try:
-        last_posted=datetime.now()
-        logger.debug(f"update_post_log: Updating post_log table with post {post.id} and last_posted {last_posted}")
         with get_db() as db:
-            # add post to post_log table
-            db_post_log = models.PostLog(
+            posts = db.query(models.Post).filter(models.Post.id.in_(list(upcoming)), models.Post.published == True).all()
+            db.expunge_all()
+    except Exception as e:
+        logger.error(f"prerender_statuses: {e}")
+        return
+    # Render for the slot the scheduler will fire, a next_run still in the write-behind buffer is newer
+    posts = [post for post in posts if post.next_run == upcoming[post.id].next_run or pending_next_runs.get(post.id) == upcoming[post.id].next_run]
+    for post in posts:
+        post.next_run = upcoming[post.id].next_run
+    logger.debug(f"prerender_statuses: Rendering {len(posts)} status(es)")
+    await prerender_dispatcher.dispatch(posts, prepare_status)
+
+async def prerender_main():
+    while True:
+        if preparing:
+            await prerender_statuses(datetime.now())
+        await asyncio.sleep(settings.prerender_interval)
+
+async def add_to_outbox(post, data: str):
+    # Insert the rendered status, leased to this task for its first delivery attempt
+    try:
+        with get_db() as db:
+            outbox_entry = models.Outbox(
                 post_id=post.id,
-                last_posted=last_posted
+                bot_token_id=post.bot_token_id,
+                payload=data,
+                idempotency_key=str(uuid.uuid4()),
+                next_attempt=datetime.now() + timedelta(seconds=settings.outbox_lease),
             )
-            db.add(db_post_log)
+            db.add(outbox_entry)
+            db.commit()
+            db.refresh(outbox_entry)
+            db.expunge(outbox_entry)
+            return outbox_entry
+    except Exception as e:
+        logger.error(f"add_to_outbox: {e}")
+
+async def deliver_status(outbox_entry, bot_token: str = None):
+    # One delivery attempt. The Idempotency-Key makes Mastodon return the status it already created
+    # instead of posting it twice when an earlier attempt reached the instance but its response was lost.
+    if bot_token == None:
+        bot_token = await get_bot_token(outbox_entry.bot_token_id)
+    if bot_token == None:
+        await finish_delivery(outbox_entry, "failed", "bot_token is Null")
+        return False
+    headers = {
+        "Authorization": f"Bearer {bot_token}",
+        "Content-Type": "application/json",
+        "Idempotency-Key": outbox_entry.idempotency_key,
+    }
+    try:
+        async with circuit_breaker.guard("mastodon") as call, rate_limit.slot(outbox_entry.bot_token_id) as bucket, http_client.get_session().post(f"{settings.mastodon_base_url}/api/v1/statuses", headers=headers, data=outbox_entry.payload) as response:
+            bucket.update(response)
+            call.failed = response.status >= 500
+            if response.status == 200:
+                await finish_delivery(outbox_entry, "sent")
+                # Update post_log table with post_id and last_posted
+                await update_post_log(outbox_entry.post_id)
+                logger.info(f"deliver_status: Status {outbox_entry.post_id} posted successfully at {datetime.now()}")
+                logger.debug(f"deliver_status: Status {outbox_entry.post_id} response: {await response.json()}")
+                return True
+            error = f"Response status: {response.status} {await response.text()}"
+            if response.status == 429:
+                await finish_delivery(outbox_entry, "retry", error, retry_at=bucket.reset_at)
+            elif response.status >= 500:
+                await finish_delivery(outbox_entry, "retry", error)
+            else:
+                # 4xx responses will not succeed on retry
+                await finish_delivery(outbox_entry, "failed", error)
+            return False
+    except circuit_breaker.CircuitOpen as e:
+        # The instance is failing, keep the status in the outbox until the breaker lets a probe through
+        await finish_delivery(outbox_entry, "retry", str(e), retry_at=e.retry_at)
+        return False
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        await finish_delivery(outbox_entry, "retry", repr(e))
+        return False
+
+def retry_delay(attempts: int):
+    # Exponential backoff: outbox_backoff_base, twice that, ... capped at outbox_backoff_max seconds
+    return min(settings.outbox_backoff_base * 2 ** (attempts - 1), settings.outbox_backoff_max)
+
+async def finish_delivery(outbox_entry, result: str, error: str = None, retry_at: datetime = None):
+    # result is "sent", "retry" or "failed". Sent statuses are removed from the outbox.
+    attempts = outbox_entry.attempts + 1
+    if result == "retry" and attempts >= settings.outbox_max_attempts:
+        result = "failed"
+    try:
+        with get_db() as db:
+            outbox_query = db.query(models.Outbox).filter(models.Outbox.id == outbox_entry.id)
+            if result == "sent":
+                outbox_query.delete(synchronize_session=False)
+            elif result == "retry":
+                next_attempt = datetime.now() + timedelta(seconds=retry_delay(attempts))
+                if retry_at != None:
+                    # Rate limit resets are sent in UTC
+                    next_attempt = max(next_attempt, retry_at.astimezone().replace(tzinfo=None))
+                outbox_query.update({"attempts": attempts, "next_attempt": next_attempt, "last_error": error}, synchronize_session=False)
+                logger.warning(f"finish_delivery: Status {outbox_entry.post_id} not posted, attempt {attempts} retrying at {next_attempt}. {error}")
+            else:
+                outbox_query.update({"attempts": attempts, "status": "failed", "last_error": error}, synchronize_session=False)
+                logger.error(f"finish_delivery: Status {outbox_entry.post_id} not posted after {attempts} attempt(s). {error}")
             db.commit()
+    except Exception as e:
+        # The lease runs out and the outbox drain picks the status up again
+        logger.error(f"finish_delivery: {e}")
+
+async def claim_outbox():
+    # Lease due pending statuses, SKIP LOCKED lets several workers drain the outbox side by side
+    try:
+        with get_db() as db:
+            outbox_entries = db.query(models.Outbox).filter(
+                models.Outbox.status == "pending",
+                models.Outbox.next_attempt <= datetime.now(),
+            ).order_by(models.Outbox.next_attempt).limit(settings.outbox_batch).with_for_update(skip_locked=True).all()
+            lease = datetime.now() + timedelta(seconds=settings.outbox_lease)
+            for outbox_entry in outbox_entries:
+                outbox_entry.next_attempt = lease
+            db.commit()
+            for outbox_entry in outbox_entries:
+                db.refresh(outbox_entry)
+            db.expunge_all()
+            return outbox_entries
+    except Exception as e:
+        logger.error(f"claim_outbox: {e}")
+        return []
+
+async def outbox_main():
+    # Retry statuses whose delivery failed, in parallel under the outbox dispatcher limits
+    while True:
+        outbox_entries = await claim_outbox()
+        if outbox_entries:
+            logger.info(f"outbox_main: Retrying {len(outbox_entries)} status(es)")
+            await outbox_dispatcher.dispatch(outbox_entries, deliver_status)
+        if len(outbox_entries) < settings.outbox_batch:
+            await asyncio.sleep(settings.outbox_interval)
+
+def outbox_status():
+    try:
+        with get_db() as db:
+            counts = db.query(models.Outbox.status, func.count(models.Outbox.id)).group_by(models.Outbox.status).all()
+        return {status: count for status, count in counts}
+    except Exception as e:
+        logger.error(f"outbox_status: {e}")
+        return {}
+
+async def update_post_log(post_id):
+    try:
+        last_posted=datetime.now()
+        logger.debug(f"update_post_log: Updating post_log table with post {post_id} and last_posted {last_posted}")
+        queue_write(post_log={"post_id": post_id, "last_posted": last_posted})
         return True            
     except Exception as e:
         logger.error(f"update_post: {e}")
 
+def queue_write(next_run=None, post_log=None):
+    # Add a next_run update (post_id, next_run) and/or a post_log row to the write-behind buffer
+    if next_run != None:
+        post_id, value = next_run
+        pending_next_runs[post_id] = value
+    if post_log != None:
+        pending_post_logs.append(post_log)
+    if len(pending_next_runs) + len(pending_post_logs) >= settings.write_behind_max_batch:
+        flush_requested.set()
+
+def write_next_runs(db, next_runs):
+    # Multi-row UPDATE posts SET next_run = ... FROM (VALUES ...) for a list of (post_id, next_run)
+    if not next_runs:
+        return
+    rows = values(column("id", Integer), column("next_run", TIMESTAMP), name="next_runs").data(next_runs)
+    db.execute(update(models.Post).where(models.Post.id == rows.c.id).values(next_run=rows.c.next_run).execution_options(synchronize_session=False))
+
+def write_post_logs(db, post_logs):
+    # Multi-row INSERT INTO post_log ... SELECT FROM (VALUES ...), rows for posts deleted in the meantime are skipped
+    if not post_logs:
+        return
+    rows = values(column("post_id", Integer), column("last_posted", TIMESTAMP), name="post_logs").data([(post_log["post_id"], post_log["last_posted"]) for post_log in post_logs])
+    db.execute(insert(models.PostLog).from_select(["post_id", "last_posted"], select(rows.c.post_id, rows.c.last_posted).join(models.Post, models.Post.id == rows.c.post_id)))
+
+async def flush_writes():
+    # Write every buffered next_run and post_log in one transaction
+    global pending_next_runs, pending_post_logs
+    if not pending_next_runs and not pending_post_logs:
+        return True
+    next_runs, pending_next_runs = pending_next_runs, {}
+    post_logs, pending_post_logs = pending_post_logs, []
+    try:
+        with get_db() as db:
+            write_next_runs(db, list(next_runs.items()))
+            write_post_logs(db, post_logs)
+            db.commit()
+        logger.debug(f"flush_writes: Wrote {len(next_runs)} next_run update(s) and {len(post_logs)} post_log row(s)")
+        return True
+    except Exception as e:
+        # Put the writes back without overwriting anything newer that was queued meanwhile
+        for post_id, next_run in next_runs.items():
+            pending_next_runs.setdefault(post_id, next_run)
+        pending_post_logs[:0] = post_logs
+        logger.error(f"flush_writes: {e}")
+        return False
+
+async def write_behind_main():
+    # Flush on a short interval or as soon as the buffer reaches write_behind_max_batch
+    while True:
+        try:
+            await asyncio.wait_for(flush_requested.wait(), timeout=settings.write_behind_interval)
+        except asyncio.TimeoutError:
+            pass
+        flush_requested.clear()
+        await flush_writes()
+
+async def shutdown():
+    # Called on application shutdown, after clock_bot_main has been cancelled, so buffered writes are not lost
+    logger.info("shutdown: Flushing buffered writes")
+    await flush_writes()
+    await http_client.close_session()
+
+def load_offloaded_slots(db, post_ids=None):
+    # (post_id, slot) of every status scheduled on Mastodon, optionally only for post_ids
+    offloaded_query = db.query(models.ScheduledStatus.post_id, models.ScheduledStatus.scheduled_at).filter(models.ScheduledStatus.scheduled_status_id != None)
+    if post_ids != None:
+        offloaded_query = offloaded_query.filter(models.ScheduledStatus.post_id.in_(post_ids))
+    return {(post_id, scheduled_at) for post_id, scheduled_at in offloaded_query.all()}
+
+async def list_scheduled_statuses(bot_token_id, bot_token):
+    # Ids of the bot account's scheduled statuses, None if the list could not be read
+    # GET /api/v1/scheduled_statuses HTTP/1.1
+    headers = {"Authorization": f"Bearer {bot_token}"}
+    scheduled_status_ids = set()
+    params = {"limit": 40}
+    while True:
+        async with circuit_breaker.guard("mastodon") as call, rate_limit.slot(bot_token_id) as bucket, http_client.get_session().get(f"{settings.mastodon_base_url}/api/v1/scheduled_statuses", headers=headers, params=params) as response:
+            bucket.update(response)
+            call.failed = response.status >= 500
+            if response.status != 200:
+                logger.error(f"list_scheduled_statuses: Bot token {bot_token_id} response status {response.status}")
+                return None
+            page = await response.json()
+        scheduled_status_ids.update(scheduled_status["id"] for scheduled_status in page)
+        if len(page) < params["limit"]:
+            return scheduled_status_ids
+        params["max_id"] = page[-1]["id"]
+
+def load_static_post(post_id):
+    # The post as stored now, None if it is no longer published and static
+    with get_db() as db:
+        post = db.query(models.Post).filter(models.Post.id == post_id, models.Post.published == True, models.Post.bot_token_id != None, ~models.Post.content.contains("{{")).first()
+        db.expunge_all()
+    return post
+
+async def schedule_on_mastodon(post, slot: datetime, jitter: float):
+    # Create a scheduled status for one slot of a static post. The slot is claimed in scheduled_statuses first
+    # so only one clock-bot process creates it.
+    # sync_scheduled_statuses loaded its posts before scheduling, render from the post as stored now.
+    if quiet_mode() == True:
+        logger.info(f"schedule_on_mastodon: Quiet mode is enabled.  Post {post.id} slot {slot} not scheduled")
+        return False
+    post = load_static_post(post.id)
+    if post == None:
+        return False
+    source = post_source(post)
+    with get_db() as db:
+        row_id = db.execute(pg_insert(models.ScheduledStatus).values(post_id=post.id, bot_token_id=post.bot_token_id, scheduled_at=slot).on_conflict_do_nothing().returning(models.ScheduledStatus.id)).scalar()
+        db.commit()
+    if row_id == None:
+        return False
+    scheduled_status_id = None
+    prepared = None
+    try:
+        post.next_run = slot
+        prepared = await render_status(post)
+        if prepared != None:
+            payload = json.loads(prepared.data)
+            # Mastodon wants an ISO 8601 time with a zone, slots are local time
+            payload["scheduled_at"] = (slot + timedelta(seconds=jitter)).astimezone(timezone.utc).isoformat()
+            headers = {
+                "Authorization": f"Bearer {prepared.bot_token}",
+                "Content-Type": "application/json",
+                "Idempotency-Key": f"clock-bot-scheduled-status-{row_id}",
+            }
+            async with circuit_breaker.guard("mastodon") as call, rate_limit.slot(post.bot_token_id) as bucket, http_client.get_session().post(f"{settings.mastodon_base_url}/api/v1/statuses", headers=headers, data=json.dumps(payload)) as response:
+                bucket.update(response)
+                call.failed = response.status >= 500
+                if response.status == 200:
+                    scheduled_status_id = (await response.json())["id"]
+                else:
+                    # e.g. 422 when the account has too many scheduled statuses, the bot posts the slot itself
+                    logger.warning(f"schedule_on_mastodon: Post {post.id} slot {slot} not scheduled.  Response status: {response.status} {await response.text()}")
+                    if response.status == 422:
+                        # Mastodon allows 300 scheduled statuses per account and 50 per day, stop asking for a while
+                        scheduling_refused[post.bot_token_id] = datetime.now() + timedelta(seconds=settings.mastodon_scheduling_refusal_backoff)
+    except Exception as e:
+        logger.error(f"schedule_on_mastodon: {e}")
+    with get_db() as db:
+        row_query = db.query(models.ScheduledStatus).filter(models.ScheduledStatus.id == row_id)
+        if scheduled_status_id != None:
+            row_query.update({"scheduled_status_id": scheduled_status_id}, synchronize_session=False)
+        else:
+            row_query.delete(synchronize_session=False)
+        db.commit()
+    if scheduled_status_id != None:
+        # An edit committed before the id was recorded was not cancelled by the posts router, which only sees
+        # recorded ids. Once the id is recorded any later edit will be, so check the post once more.
+        current = load_static_post(post.id)
+        if current == None or post_source(current) != source:
+            logger.info(f"schedule_on_mastodon: Post {post.id} changed while slot {slot} was scheduled, cancelling it")
+            try:
+                if await delete_scheduled_status(post.bot_token_id, prepared.bot_token, scheduled_status_id):
+                    with get_db() as db:
+                        db.query(models.ScheduledStatus).filter(models.ScheduledStatus.id == row_id).delete(synchronize_session=False)
+                        db.commit()
+                else:
+                    logger.error(f"schedule_on_mastodon: Post {post.id} scheduled status {scheduled_status_id} not cancelled")
+            except Exception as e:
+                logger.error(f"schedule_on_mastodon: Post {post.id} scheduled status {scheduled_status_id} not cancelled: {e}")
+            return False
+    if scheduled_status_id == None:
+        if prepared != None:
+            release_media(prepared.media)
+        return False
+    offloaded_slots.add((post.id, slot))
+    logger.info(f"schedule_on_mastodon: Post {post.id} slot {slot} scheduled on Mastodon as {scheduled_status_id}")
+    return True
+
+async def delete_scheduled_status(bot_token_id, bot_token, scheduled_status_id):
+    # DELETE /api/v1/scheduled_statuses/:id HTTP/1.1, a 404 means it was published or deleted already
+    headers = {"Authorization": f"Bearer {bot_token}"}
+    async with circuit_breaker.guard("mastodon") as call, rate_limit.slot(bot_token_id) as bucket, http_client.get_session().delete(f"{settings.mastodon_base_url}/api/v1/scheduled_statuses/{scheduled_status_id}", headers=headers) as response:
+        bucket.update(response)
+        call.failed = response.status >= 500
+        return response.status in (200, 404)
+
+async def cancel_scheduled_statuses(post_id):
+    # Called by the posts router before a post is deleted and after it is updated, the upcoming slots are
+    # scheduled again from the new version of the post by sync_scheduled_statuses
+    try:
+        with get_db() as db:
+            scheduled_statuses = db.query(models.ScheduledStatus).filter(models.ScheduledStatus.post_id == post_id, models.ScheduledStatus.scheduled_at > datetime.now(), models.ScheduledStatus.scheduled_status_id != None).all()
+            db.expunge_all()
+        cancelled = []
+        for scheduled_status in scheduled_statuses:
+            bot_token = await get_bot_token(scheduled_status.bot_token_id)
+            try:
+                if bot_token != None and await delete_scheduled_status(scheduled_status.bot_token_id, bot_token, scheduled_status.scheduled_status_id):
+                    cancelled.append(scheduled_status.id)
+                else:
+                    logger.error(f"cancel_scheduled_statuses: Post {post_id} scheduled status {scheduled_status.scheduled_status_id} not cancelled")
+            except Exception as e:
+                logger.error(f"cancel_scheduled_statuses: Post {post_id} scheduled status {scheduled_status.scheduled_status_id} not cancelled: {e}")
+        if cancelled:
+            with get_db() as db:
+                db.query(models.ScheduledStatus).filter(models.ScheduledStatus.id.in_(cancelled)).delete(synchronize_session=False)
+                db.commit()
+            logger.info(f"cancel_scheduled_statuses: Post {post_id} cancelled {len(cancelled)} scheduled status(es)")
+    except Exception as e:
+        logger.error(f"cancel_scheduled_statuses: {e}")
+
+async def sync_scheduled_statuses():
+    # Keep the next mastodon_scheduled_count slots of every static post scheduled on Mastodon
+    global offloaded_slots
+    current_time = datetime.now()
+    with get_db() as db:
+        scheduled_statuses = db.query(models.ScheduledStatus).filter(models.ScheduledStatus.scheduled_status_id != None).all()
+        published_post_ids = {post_id for post_id, in db.query(models.Post.id).filter(models.Post.published == True).all()}
+        posts = db.query(models.Post).filter(models.Post.published == True, models.Post.bot_token_id != None, ~models.Post.content.contains("{{")).all()
+        db.expunge_all()
+    # Slots that have been published by Mastodon are logged like statuses the bot posted. Their rows are kept,
+    # and their slots stay in offloaded_slots, until the post's next_run has moved past them, so the scheduler
+    # and catch-up do not post them again.
+    published = []
+    for scheduled_status in scheduled_statuses:
+        entry = schedule_queue.get(scheduled_status.post_id)
+        jitter = entry.jitter if entry != None else 0.0
+        if scheduled_status.scheduled_at + timedelta(seconds=jitter + settings.missed_run_grace) >= current_time:
+            continue
+        if entry != None and entry.next_run != None and entry.next_run <= scheduled_status.scheduled_at:
+            continue
+        if entry == None and scheduled_status.post_id in published_post_ids:
+            # Being posted or reloaded, not back in the queue yet
+            continue
+        published.append(scheduled_status.id)
+    if published:
+        with get_db() as db:
+            logged = db.execute(delete(models.ScheduledStatus).where(models.ScheduledStatus.id.in_(published)).returning(models.ScheduledStatus.post_id, models.ScheduledStatus.scheduled_at)).all()
+            db.commit()
+        for post_id, scheduled_at in logged:
+            queue_write(post_log={"post_id": post_id, "last_posted": scheduled_at})
+        scheduled_statuses = [scheduled_status for scheduled_status in scheduled_statuses if scheduled_status.id not in published]
+    # Statuses removed on Mastodon, e.g. by hand, are posted by the bot instead
+    removed = []
+    for bot_token_id in {scheduled_status.bot_token_id for scheduled_status in scheduled_statuses}:
+        bot_token = await get_bot_token(bot_token_id)
+        remote_ids = await list_scheduled_statuses(bot_token_id, bot_token) if bot_token != None else None
+        if remote_ids == None:
+            continue
+        removed += [scheduled_status.id for scheduled_status in scheduled_statuses if scheduled_status.bot_token_id == bot_token_id and scheduled_status.scheduled_status_id not in remote_ids and scheduled_status.scheduled_at > current_time + timedelta(minutes=1)]
+    if removed:
+        logger.warning(f"sync_scheduled_statuses: {len(removed)} scheduled status(es) no longer on Mastodon")
+        with get_db() as db:
+            db.query(models.ScheduledStatus).filter(models.ScheduledStatus.id.in_(removed)).delete(synchronize_session=False)
+            db.commit()
+        scheduled_statuses = [scheduled_status for scheduled_status in scheduled_statuses if scheduled_status.id not in removed]
+    offloaded_slots = {(scheduled_status.post_id, scheduled_status.scheduled_at) for scheduled_status in scheduled_statuses}
+    # Scheduled statuses are published by Mastodon, nothing new is scheduled in quiet mode
+    if quiet_mode() == True:
+        return
+    for bot_token_id, refused_until in list(scheduling_refused.items()):
+        if refused_until <= current_time:
+            del scheduling_refused[bot_token_id]
+    # Schedule missing slots, Mastodon only accepts times at least 5 minutes ahead
+    for post in posts:
+        entry = schedule_queue.get(post.id)
+        if entry == None or post.bot_token_id in scheduling_refused:
+            continue
+        try:
+            schedule = compile_cron(post.crontab_schedule)
+            slot = schedule.next_after(current_time + timedelta(seconds=settings.mastodon_scheduling_min_lead - entry.jitter))
+            for _ in range(settings.mastodon_scheduled_count):
+                if (post.id, slot) not in offloaded_slots:
+                    if not await schedule_on_mastodon(post, slot, entry.jitter):
+                        break
+                slot = schedule.next_after(slot)
+        except Exception as e:
+            logger.error(f"sync_scheduled_statuses: Post {post.id} {e}")
+
+async def scheduled_statuses_main():
+    while True:
+        try:
+            await sync_scheduled_statuses()
+        except Exception as e:
+            logger.error(f"scheduled_statuses_main: {e}")
+        await asyncio.sleep(settings.mastodon_scheduling_interval)
+
 async def get_bot_token(bot_token_id):
     try:
         with get_db() as db:
@@ -165,90 +958,250 @@ async def get_bot_token(bot_token_id):
     except Exception as e:
         logger.error(f"get_bot_token: {e}")
 
+async def get_media(post, attachment: Attachment):
+    # Returns (media_key, media_id). An unused upload of the same attachment for the same bot is taken from
+    # uploaded_media instead of uploading the file again.
+    try:
+        media_key = await uploaded_media.key(attachment, post.bot_token_id)
+    except Exception as e:
+        logger.error(f"get_media: {e}")
+        return None, await upload_media(post, attachment)
+    media_id = uploaded_media.take(media_key)
+    if media_id == None and media_key in media_uploads:
+        # Wait for the upload started ahead of this post instead of uploading the file again
+        await asyncio.wait(set(media_uploads[media_key]), timeout=settings.media_processing_timeout)
+        media_id = uploaded_media.take(media_key)
+    if media_id != None:
+        logger.debug(f"get_media: Post {post.id} reusing media_id {media_id}")
+        return media_key, media_id
+    return media_key, await upload_media(post, attachment)
+
+def release_media(media):
+    # Return (media_key, media_id) pairs that were uploaded but not attached to a status
+    for media_key, media_id in media:
+        if media_key != None:
+            uploaded_media.put(media_key, media_id)
+
 # Use AIOHTTP to upload media and return media_id, include error handling and logging
 # POST /api/v2/media HTTP/1.1
 # https://docs.joinmastodon.org/methods/media/
-async def upload_media(post):
-    # check if media_path in post is not null or empty
-    if post.media_path == None or post.media_path == "":
+async def upload_media(post, attachment: Attachment):
+    # check if media_path in attachment is not null or empty
+    if attachment.media_path == None or attachment.media_path == "":
         logger.error(f"upload_media: Post {post.id} media_path is Null")
         return None
     try:
-        logger.debug(f"upload_media: Uploading media for post {post.id} media_path {post.media_path}")
-        # with the media_path open check file has has a mime type and upload media
-        with open(post.media_path, "rb") as media:
-            media_mime_type = magic.from_buffer(media.read(1024), mime=True)
-            logger.debug(f"upload_media: Post {post.id} media_mime_type {media_mime_type}")
-            # reset file pointer to start of file
-            media.seek(0)
+        logger.debug(f"upload_media: Uploading media for post {post.id} media_path {attachment.media_path}")
+        # mime type is detected once per file version, the file is opened off the event loop
+        media_mime_type = await uploaded_media.mime_type(attachment.media_path)
+        logger.debug(f"upload_media: Post {post.id} media_mime_type {media_mime_type}")
+        with await asyncio.to_thread(open, attachment.media_path, "rb") as media:
             # get bot_token from post.bot_token_id
             bot_token = await get_bot_token(post.bot_token_id)
             # upload media
             headers = {
                 "Authorization" : f"Bearer {bot_token}"
             }
-            data = {
-                "file": media
-            }
-            async with aiohttp.ClientSession() as session:
-                async with session.post(f"{settings.mastodon_base_url}/api/v2/media", headers=headers, data=data) as response:
-                    if response.status == 200 or response.status == 202:
-                        # logger debug response
-                        logger.debug(f"upload_media: Response for post {post.id} media_path {post.media_path} media_mime_type {media_mime_type} {await response.text()}")
-                        # extract id from json response
-                        media_id = (await response.json())['id']
-                        logger.debug(f"upload_media: Media uploaded successfully for post {post.id} media_id {media_id}")
-                        # return media_id
-                        # if 202 then media is still processing
-                        # GET /api/v1/media/:id HTTP/1.1
-                        if response.status == 202:
-                            logger.warning(f"upload_media: Media still processing for post {post.id} media_path {post.media_path} media_mime_type {media_mime_type}")
-                            # while media is still processing wait 5 seconds and try again
-                            while response.status == 202 or response.status == 206:
-                                await asyncio.sleep(5)
-                                async with aiohttp.ClientSession() as session:
-                                    async with session.get(f"{settings.mastodon_base_url}/api/v1/media/{media_id}", headers=headers) as response:
-                                        if response.status == 200:
-                                            # logger debug response
-                                            logger.debug(f"upload_media: Response for post {post.id} media_path {post.media_path} media_mime_type {media_mime_type} {await response.text()}")
-                                            # extract id from json response
-                                            media_id = (await response.json())['id']
-                                            logger.debug(f"upload_media: Media uploaded successfully for post {post.id} media_id {media_id}")
-                                            return media_id
-                                        elif response.status == 206:
-                                            logger.warning(f"upload_media: Media still processing for post {post.id} media_path {post.media_path} media_mime_type {media_mime_type}")
-                                        else:
-                                            logger.error(f"upload_media: Error uploading media for post {post.id} media_path {post.media_path} media_mime_type {media_mime_type}")
-                                            return None
-                        else:
-                            return media_id
-                    elif response.status == 422:
-                        logger.error(f"upload_media: Error uploading media for post {post.id} media_path {post.media_path} media_mime_type {media_mime_type}")
-                        return None
-                    else:
-                        logger.error(f"upload_media: Error uploading media for post {post.id}")
-                        return None
+            # aiohttp streams file objects in 64 KiB chunks read in the default executor,
+            # so memory use does not grow with the file size
+            data = aiohttp.FormData()
+            data.add_field("file", media, filename=os.path.basename(attachment.media_path), content_type=media_mime_type)
+            if attachment.description != None:
+                data.add_field("description", attachment.description)
+            if attachment.focus != None:
+                data.add_field("focus", attachment.focus)
+            async with circuit_breaker.guard("mastodon") as call, rate_limit.slot(post.bot_token_id, "media") as bucket, http_client.get_session().post(f"{settings.mastodon_base_url}/api/v2/media", headers=headers, data=data) as response:
+                bucket.update(response)
+                call.failed = response.status >= 500
+                if response.status == 200 or response.status == 202:
+                    # logger debug response
+                    logger.debug(f"upload_media: Response for post {post.id} media_path {attachment.media_path} media_mime_type {media_mime_type} {await response.text()}")
+                    # extract id from json response
+                    media_id = (await response.json())['id']
+                    processing = response.status == 202
+                    logger.debug(f"upload_media: Media uploaded successfully for post {post.id} media_id {media_id}")
+                elif response.status == 422:
+                    logger.error(f"upload_media: Error uploading media for post {post.id} media_path {attachment.media_path} media_mime_type {media_mime_type}")
+                    return None
+                else:
+                    logger.error(f"upload_media: Error uploading media for post {post.id}")
+                    return None
+        # if 202 then media is still processing, polled after the upload's connection, circuit call and
+        # rate limit slot have been released
+        if processing:
+            logger.debug(f"upload_media: Media still processing for post {post.id} media_path {attachment.media_path} media_mime_type {media_mime_type}")
+            return await wait_for_media(post, media_id, headers)
+        return media_id
     except Exception as e:
         logger.error(f"upload_media: {e}")
 
 
-async def clear_next_run():
+# GET /api/v1/media/:id HTTP/1.1 returns 206 while the media is processing and 200 once it is ready
+async def wait_for_media(post, media_id, headers):
+    # Poll with adaptive backoff: quick first checks for images, backing off to media_poll_max for long videos
+    delay = settings.media_poll_initial
+    deadline = time.monotonic() + settings.media_processing_timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(delay)
+        async with circuit_breaker.guard("mastodon") as call, rate_limit.slot(post.bot_token_id) as bucket, http_client.get_session().get(f"{settings.mastodon_base_url}/api/v1/media/{media_id}", headers=headers) as response:
+            bucket.update(response)
+            call.failed = response.status >= 500
+            if response.status == 200:
+                logger.debug(f"wait_for_media: Media {media_id} for post {post.id} processed")
+                return media_id
+            elif response.status != 206:
+                logger.error(f"wait_for_media: Error processing media {media_id} for post {post.id} response status {response.status}")
+                return None
+        delay = min(delay * 2, settings.media_poll_max)
+    logger.error(f"wait_for_media: Media {media_id} for post {post.id} not processed within {settings.media_processing_timeout}s")
+    return None
+
+async def prefetch_media(current_time: datetime):
+    # Start uploads for media of posts firing within media_upload_lead seconds, so they are processed
+    # and waiting in uploaded_media when the post fires
+    upcoming = {}
+    for entry in schedule_queue.upcoming(current_time + timedelta(seconds=settings.media_upload_lead)):
+        if entry.has_media and prefetched_media.get(entry.post_id) != entry.next_run and (entry.post_id, entry.next_run) not in offloaded_slots:
+            prefetched_media[entry.post_id] = entry.next_run
+            upcoming[entry.post_id] = entry
+    if not upcoming:
+        return
     try:
         with get_db() as db:
-            logger.debug("clear_next_run: Clearing next_run values")
-            # get all posts
-            posts = db.query(models.Post).all()
-            for post in posts:
-                # update next_run to Null
-                db.query(models.Post).filter(models.Post.id == post.id).update({"next_run": None})
-                db.commit()
+            posts = db.query(models.Post).filter(models.Post.id.in_(list(upcoming)), models.Post.published == True).all()
+            db.expunge_all()
+    except Exception as e:
+        logger.error(f"prefetch_media: {e}")
+        return
+    needed = {}
+    for post in posts:
+        for attachment in post_attachments(post):
+            needed.setdefault((attachment, post.bot_token_id), []).append(post)
+    for (attachment, bot_token_id), attachment_posts in needed.items():
+        await prefetch_upload(attachment_posts, attachment)
+
+async def prefetch_upload(posts, attachment: Attachment):
+    # Upload as many copies as the upcoming posts of one attachment and bot need, minus unused ones already cached
+    post = posts[0]
+    try:
+        media_key = await uploaded_media.key(attachment, post.bot_token_id)
+    except Exception as e:
+        logger.error(f"prefetch_upload: Post {post.id} {e}")
+        return
+    missing = len(posts) - uploaded_media.available(media_key) - len(media_uploads.get(media_key, ()))
+    for post in posts[:max(missing, 0)]:
+        task = asyncio.create_task(upload_media(post, attachment))
+        media_uploads.setdefault(media_key, set()).add(task)
+        task.add_done_callback(lambda task, media_key=media_key: prefetch_done(media_key, task))
+    if missing > 0:
+        logger.debug(f"prefetch_upload: Uploading {missing} copy(ies) of {attachment.media_path} ahead of post {posts[0].id}")
+
+def prefetch_done(media_key, task):
+    media_uploads[media_key].discard(task)
+    if not media_uploads[media_key]:
+        del media_uploads[media_key]
+    if not task.cancelled() and task.exception() == None and task.result() != None:
+        uploaded_media.put(media_key, task.result())
+
+async def media_prefetch_main():
+    while True:
+        if preparing:
+            await prefetch_media(datetime.now())
+        # Forget posts that have fired
+        for post_id in [post_id for post_id in prefetched_media if post_id not in schedule_queue or schedule_queue.get(post_id).next_run != prefetched_media[post_id]]:
+            del prefetched_media[post_id]
+        await asyncio.sleep(settings.media_prefetch_interval)
+
+async def prepare_schedule():
+    # Startup pass: keep persisted next_run values that are still the next slot of their crontab_schedule,
+    # recompute stale or invalid ones in memory and write them back with a single UPDATE.
+    global offloaded_slots
+    started = time.monotonic()
+    try:
+        current_time = datetime.now()
+        schedule_queue.clear()
+        with get_db() as db:
+            scheduled_posts = await get_scheduled_posts(db)
+            # Slots scheduled on Mastodon before a restart must be known before anything is dispatched
+            offloaded_slots = load_offloaded_slots(db)
+            next_runs = []
+            invalid = 0
+            missed = 0
+            for entry in scheduled_posts:
+                try:
+                    schedule = compile_cron(entry.crontab_schedule)
+                    next_run = schedule.next_after(current_time)
+                except ValueError as e:
+                    invalid += 1
+                    logger.error(f"prepare_schedule: Post {entry.post_id} crontab_schedule {entry.crontab_schedule} is not valid: {e}")
+                    continue
+                past_slot = entry.next_run != None and entry.next_run < current_time and schedule.matches(entry.next_run) and (entry.post_id, entry.next_run) not in offloaded_slots
+                # Same test as plan_next_run: inside missed_run_grace plus the post's jitter the slot is still on time,
+                # e.g. a quick restart or another worker starting while a post waits for its jitter offset
+                on_time = past_slot and (current_time - entry.next_run).total_seconds() - entry.jitter <= settings.missed_run_grace
+                if on_time or (past_slot and settings.missed_run_policy != "skip"):
+                    # Left for claim_due_posts and plan_next_run. Missed while the bot was down, left for the missed
+                    # run policy. Slots published by Mastodon in the meantime are not missed and move on to the next slot.
+                    if not on_time:
+                        missed += 1
+                    next_run = entry.next_run
+                elif entry.next_run != next_run:
+                    next_runs.append((entry.post_id, next_run))
+                schedule_queue.push(entry._replace(next_run=next_run))
+            write_next_runs(db, next_runs)
+            db.commit()
+        startup_stats.update({
+            "posts": len(scheduled_posts),
+            "kept": len(scheduled_posts) - len(next_runs) - invalid - missed,
+            "recomputed": len(next_runs),
+            "invalid": invalid,
+            "missed": missed,
+            "seconds": round(time.monotonic() - started, 3),
+        })
+        logger.info(f"prepare_schedule: {startup_stats['posts']} post(s), {startup_stats['kept']} kept, {startup_stats['recomputed']} recomputed, {invalid} invalid, {missed} missed in {startup_stats['seconds']}s")
         return True
     except Exception as e:
-        logger.error(f"clear_next_run: {e}")
+        logger.error(f"prepare_schedule: {e}")
+        return False
 
 async def clock_bot_main():
-    while True:
-        logger.debug("clock_bot_main: Checking for scheduled posts")
-        await check_scheduled_posts()
-        await asyncio.sleep(10)
+    global scheduler_running, schedule_loaded
+    scheduler_running = True
+    listener_task = asyncio.create_task(database.listen(handle_notification, handle_listen_connect))
+    prepare_lock_task = asyncio.create_task(database.hold_lock(database.PREPARE_LOCK_ID, handle_prepare_lock))
+    tasks = [listener_task, prepare_lock_task]
+    try:
+        # Load the schedule once LISTEN has started so no change made in between is missed. If the listener
+        # cannot connect in time the schedule is loaded anyway and reloaded when it does.
+        try:
+            await asyncio.wait_for(listener_connected.wait(), timeout=10)
+        except asyncio.TimeoutError:
+            logger.warning("clock_bot_main: Not listening for schedule changes yet, loading the schedule anyway")
+        schedule_loaded = True
+        if not await prepare_schedule():
+            await load_schedule()
+        tasks.append(asyncio.create_task(write_behind_main()))
+        tasks.append(asyncio.create_task(catch_up_main()))
+        tasks.append(asyncio.create_task(outbox_main()))
+        tasks.append(asyncio.create_task(media_prefetch_main()))
+        tasks.append(asyncio.create_task(prerender_main()))
+        if settings.mastodon_scheduling:
+            tasks.append(asyncio.create_task(scheduled_statuses_main()))
+        while True:
+            schedule_changed.clear()
+            await apply_schedule_changes()
+            logger.debug("clock_bot_main: Checking for scheduled posts")
+            await check_scheduled_posts()
+            await wait_for_next_run()
+    finally:
+        # Stop the background loops and let posts already being sent finish before shutdown() flushes their
+        # post_log rows and closes the HTTP session
+        scheduler_running = False
+        schedule_loaded = False
+        listener_connected.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await dispatcher.drain()
+        logger.info("clock_bot_main: Scheduler stopped")
        
\ No newline at end of file
@@ -1,13 +1,15 @@
 from .config import settings
 from .database import get_db
-from . import models, schemas
+from . import models, schemas, json_path
+from .dynamic_cache import ResponseCache
+from .list_index import ListIndex
 
 import re
-import random
 from datetime import datetime
+from functools import lru_cache
+from typing import NamedTuple
 from fastapi import Depends, FastAPI, HTTPException, status, Response, File, UploadFile
 import asyncio
-import aiohttp
 import json
 import croniter
 import magic
@@ -16,127 +18,149 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-''' CHECK COMMANDS
+''' TEMPLATES
 *********************************************************************************************************************
 '''
 
-# Handler to check post.content for commands inside of e.g. {{posts_random: 1}} or {{posts_static: 1}} with variable and call that function from clock_post_commands.py
-# Return the result of that function and replace the command with the result
-async def check_post_commands(post):
+# Commands usable in post content as {{name: variable, variable}}, filled in by register_command
+COMMANDS = {}
+
+def register_command(name: str):
+    def register(function):
+        COMMANDS[name] = function
+        return function
+    return register
+
+class TemplateCommand(NamedTuple):
+    name: str
+    variables: tuple
+    # The {{...}} text as written in the post, left in place if the command is unknown
+    source: str
+
+COMMAND_PATTERN = re.compile(r'{{\s*(.*?)\s*}}')
+
+# Parsed once per distinct post.content, lru_cache hashes the content string for the lookup
+@lru_cache(maxsize=1024)
+def compile_template(content: str):
+    # Split content into literal strings and TemplateCommands
+    segments = []
+    position = 0
+    for match in COMMAND_PATTERN.finditer(content):
+        if match.start() > position:
+            segments.append(content[position:match.start()])
+        function, separator, variable = match.group(1).partition(":") # split only the first ":" in the string the rest will be in variable
+        variables = tuple(item.strip() for item in variable.split(",")) if separator else ()
+        segments.append(TemplateCommand(function.strip(), variables, match.group(0)))
+        position = match.end()
+    if position < len(content):
+        segments.append(content[position:])
+    return tuple(segments)
+
+async def run_command(command: TemplateCommand, post_id=None):
+    function = COMMANDS.get(command.name)
+    if function == None:
+        logger.error(f"run_command: Post {post_id} unknown command {command.source}")
+        return command.source
+    logger.debug(f"run_command: Post {post_id} function: {command.name} variable(s): {command.variables}")
     try:
-        logger.debug(f"check_post_commands: Checking post {post.id} for commands")
-        # Use regular expression to search for commands in post.content
-        commands = re.findall(r'{{\s*(.*?)\s*}}', post.content)
-        for command in commands:
-            # Split command into function and variable
-            function, variable = command.split(":", 1) # split only the first ":" in the string the rest will be in variable
-            function = function.strip()
-            variable = variable.strip()
-            # Call function from clock_post_commands.py
-            logger.debug(f"check_post_commands: Post {post.id} function: {function} variable(s): {variable}")
-            # Split variable into multiple variables
-            variables = variable.split(",")
-            # put variables into a list
-            variables_list = []
-            for variable in variables:
-                variables_list.append(variable.strip())
-            # Call function from clock_post_commands.py
-            result = await globals()[function](*variables_list)
-            # Check if result is False and replace with empty string
-            if not result:
-                result = ""
-            # Replace command with result
-            post.content = post.content.replace(f"{{{{{command}}}}}", result, 1) # replace the first command that matches
-
-        logger.debug(f"check_post_commands: Post {post.id} content: {post.content}")
-        return post
+        result = await function(*command.variables)
     except Exception as e:
-        logger.error(f"check_post_commands: {e}")
-        return post
+        logger.error(f"run_command: Post {post_id} {command.source} {e}")
+        result = False
+    # Failed commands render as an empty string
+    return str(result) if result else ""
+
+# Render post content with every command replaced by its result. The post itself is not modified.
+# Commands run concurrently, results are put back in template order.
+async def render_template(content: str, post_id=None):
+    segments = compile_template(content)
+    commands = {index: asyncio.create_task(run_command(segment, post_id))
+                for index, segment in enumerate(segments) if isinstance(segment, TemplateCommand)}
+    try:
+        pending = set()
+        if commands:
+            done, pending = await asyncio.wait(commands.values(), timeout=settings.template_timeout)
+            if pending:
+                logger.warning(f"render_template: Post {post_id} {len(pending)} command(s) not done after {settings.template_timeout}s")
+        output = []
+        for index, segment in enumerate(segments):
+            if index not in commands:
+                output.append(segment)
+            elif commands[index] in pending:
+                output.append("")
+            else:
+                output.append(commands[index].result())
+    finally:
+        # Commands past the deadline, or all of them if rendering was cancelled
+        for task in commands.values():
+            if not task.done():
+                task.cancel()
+    rendered = "".join(output)
+    logger.debug(f"render_template: Post {post_id} content: {rendered}")
+    return rendered
 
 ''' COMMANDS
 *********************************************************************************************************************
 '''
 
+# Lists are read from an in-memory index, the lists router invalidates it on changes
+list_contents = ListIndex()
+
 # Function to randomly select a item from a list
+@register_command("list_random")
 async def list_random(list_id: int):
     try:
-        with get_db() as db:
-            logger.debug(f'Getting random list content from database for list ID {str(list_id)}')
-            db_list = db.query(models.List).filter(models.List.id == list_id).first()
-            if not db_list:
-                logger.error(f'List with ID {str(list_id)} was not found.')
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                    detail=f"List with ID {str(list_id)} was not found.")
-            else:
-                db_list_content = db.query(models.ListContent).filter(models.ListContent.list_id == list_id).all()
-                if not db_list_content:
-                    logger.error(f'List with ID {str(list_id)} has no content.')
-                    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                        detail=f"List with ID {str(list_id)} has no content.")
-                else:
-                    random_item = random.choice(db_list_content)
-                    logger.debug(f'Random item from list ID {str(list_id)} is {random_item.content}')
-                    return str(random_item.content)
+        logger.debug(f'Getting random list content for list ID {str(list_id)}')
+        random_item = list_contents.random_item(int(list_id))
+        logger.debug(f'Random item from list ID {str(list_id)} is {random_item}')
+        return str(random_item)
     except Exception as e:
         logger.error(f"random_list: {e}")
         return False
 
 # Function to select a static item from a list
+@register_command("list_static")
 async def list_static(list_id: int, item_id: int):
     try:
-        with get_db() as db:
-            # Get list from database with list_id
-            logger.debug(f'Getting static list content from database for list ID {str(list_id)}')
-            db_list = db.query(models.List).filter(models.List.id == list_id).first()
-            if not db_list:
-                logger.error(f'List with ID {str(list_id)} was not found.')
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                    detail=f"List with ID {str(list_id)} was not found.")
-            else:
-                # Get list content from database with list_id and item_id
-                db_list_content = db.query(models.ListContent).filter(models.ListContent.list_id == list_id, models.ListContent.item_id == item_id).first()
-                if not db_list_content:
-                    logger.error(f'Item with ID {str(item_id)} was not found in list with ID {str(list_id)}.')
-                    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                        detail=f"Item with ID {str(item_id)} was not found in list with ID {str(list_id)}.")
-                else:
-                    logger.debug(f'Static item from list ID {str(list_id)} is {db_list_content.content}')
-                    return str(db_list_content.content)
+        logger.debug(f'Getting static list content for list ID {str(list_id)}')
+        static_item = list_contents.item(int(list_id), int(item_id))
+        logger.debug(f'Static item from list ID {str(list_id)} is {static_item}')
+        return str(static_item)
     except Exception as e:
         logger.error(f"static_list: {e}")
         return False
-        
+
+# Last value returned by dynamic for each (endpoint, key), used while the endpoint is failing
+dynamic_fallbacks = {}
+dynamic_responses = ResponseCache()
+
 # Function to get dynamic text from a API endpoint
 # Enpoint must return a JSON object vlaue
 # Variables passed to fucntion are:
 # 1. API endpoint
 # 2. JSON object key
+# 3. Optional, seconds a response from the endpoint may be reused, dynamic_cache_ttl by default
 # Example: https://stranger.social/api/v1/instance {{dynamic:https://stranger.social/api/v1/instance,key}}
-# key will be sent as eg. "stats.user_count"
-async def dynamic(endpoint: str, key: str):
+# key will be sent as eg. "stats.user_count", list items by index eg. "accounts.0.username"
+@register_command("dynamic")
+async def dynamic(endpoint: str, key: str, ttl: str = None):
     try:
         logger.debug(f"dynamic: Getting dynamic text from API endpoint {endpoint}")
-        async with aiohttp.ClientSession() as session:
-            async with session.get(endpoint) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    logger.debug(f"dynamic: API endpoint {endpoint} returned {data}")
-                    # Get value from JSON object
-                    value = data
-                    for key in key.split("."):
-                        value = value.get(key)
-                    if not value:
-                        logger.error(f"dynamic: Key {key} does not exist in JSON object")
-                        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                            detail=f"Key {key} does not exist in JSON object")
-                    else:
-                        logger.debug(f"dynamic: Value {value} from key {key} in JSON object")
-                        return str(value)
-                else:
-                    logger.error(f"dynamic: API endpoint {endpoint} returned {response.status}")
-                    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                        detail=f"API endpoint {endpoint} returned {response.status}")
+        # Responses are shared by every post reading the same endpoint
+        response = await dynamic_responses.get(endpoint, float(ttl) if ttl else None)
+        # Get value from JSON object, list items by index e.g. "items.0.name" or "items[0].name"
+        value = response.value(key)
+        if value is json_path.MISSING:
+            value = None
+        if not value:
+            logger.error(f"dynamic: Key {key} does not exist in JSON object")
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"Key {key} does not exist in JSON object")
+        else:
+            logger.debug(f"dynamic: Value {value} from key {key} in JSON object")
+            dynamic_fallbacks[(endpoint, key)] = str(value)
+            return str(value)
     except Exception as e:
         logger.error(f"dynamic: {e}")
-        return False
\ No newline at end of file
+        # Fall back to the last value read for this endpoint and key
+        return dynamic_fallbacks.get((endpoint, key), False)
@@ -1,4 +1,5 @@
-from pydantic import BaseSettings
+from pydantic import BaseSettings, confloat
+from typing import Literal
 
 class Settings(BaseSettings):
     quiet: bool = True
@@ -15,6 +16,55 @@ class Settings(BaseSettings):
     algorithm: str
     access_token_expire_minutes: int
     tz: str
+    embedded_scheduler: bool = True
+    max_concurrent_posts: int = 20
+    max_concurrent_posts_per_bot: int = 2
+    scheduler_max_sleep: int = 300
+    scheduler_claim_batch: int = 100
+    missed_run_policy: Literal["skip", "coalesce", "replay"] = "coalesce"
+    missed_run_grace: int = 60
+    missed_run_replay_limit: int = 10
+    catch_up_rate: confloat(gt=0) = 1.0
+    jitter_seconds: int = 0
+    http_pool_size: int = 100
+    http_pool_size_per_host: int = 20
+    http_dns_cache_ttl: int = 300
+    http_keepalive_timeout: float = 60.0
+    http_timeout: float = 60.0
+    http_connect_timeout: float = 10.0
+    rate_limit_reserve: int = 2
+    dynamic_timeout: float = 5.0
+    dynamic_max_concurrency_per_host: int = 4
+    template_timeout: float = 10.0
+    dynamic_cache_ttl: float = 30.0
+    dynamic_cache_stale: float = 300.0
+    dynamic_cache_size: int = 256
+    dynamic_max_body: int = 1048576
+    circuit_failure_threshold: int = 5
+    circuit_reset_timeout: float = 30.0
+    outbox_interval: float = 5.0
+    mastodon_scheduling: bool = False
+    mastodon_scheduled_count: int = 5
+    mastodon_scheduling_min_lead: int = 600
+    mastodon_scheduling_interval: float = 60.0
+    mastodon_scheduling_refusal_backoff: int = 3600
+    prerender_lead: int = 60
+    prerender_interval: float = 5.0
+    prerender_max_age: int = 300
+    media_cache_ttl: int = 43200
+    media_upload_lead: int = 120
+    media_prefetch_interval: float = 10.0
+    media_poll_initial: float = 0.5
+    media_poll_max: float = 10.0
+    media_processing_timeout: int = 600
+    outbox_batch: int = 50
+    outbox_concurrency: int = 10
+    outbox_lease: int = 300
+    outbox_max_attempts: int = 8
+    outbox_backoff_base: float = 10.0
+    outbox_backoff_max: float = 600.0
+    write_behind_interval: float = 1.0
+    write_behind_max_batch: int = 500
 
     class Config:
         env_file = ".env"
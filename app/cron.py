@@ -0,0 +1,206 @@
+from datetime import datetime, timedelta
+from functools import lru_cache
+import croniter
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+'''
+Compiled cron schedules
+
+Cron expressions are compiled once into per-field bitmasks and cached by expression string, so posts with the same
+crontab_schedule share one compiled schedule. Semantics follow croniter: 5 fields (minute hour day month weekday)
+or 6 fields with seconds last, day of month and day of week are OR'ed when both are restricted.
+Expressions using croniter extensions (L, #, H) fall back to a croniter backed schedule with the same API.
+'''
+
+ALIASES = {
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+}
+
+MONTHS = {"jan": 1, "feb": 2, "mar": 3, "apr": 4, "may": 5, "jun": 6, "jul": 7, "aug": 8, "sep": 9, "oct": 10, "nov": 11, "dec": 12}
+WEEKDAYS = {"sun": 0, "mon": 1, "tue": 2, "wed": 3, "thu": 4, "fri": 5, "sat": 6}
+
+# (low, high, names) for minute, hour, day, month, weekday, second
+FIELDS = (
+    (0, 59, {}),
+    (0, 23, {}),
+    (1, 31, {}),
+    (1, 12, MONTHS),
+    (0, 7, WEEKDAYS),
+    (0, 59, {}),
+)
+
+# Give up looking for a match after this many years, e.g. "0 0 30 2 *" never fires
+MAX_YEARS = 50
+
+
+class UnsupportedCronSyntax(ValueError):
+    pass
+
+
+def _parse_value(value: str, names: dict):
+    value = value.lower()
+    if value in names:
+        return names[value]
+    if not value.isdigit():
+        raise UnsupportedCronSyntax(value)
+    return int(value)
+
+def _parse_field(field: str, index: int):
+    # Returns (bitmask, is_wildcard)
+    low, high, names = FIELDS[index]
+    mask = 0
+    for part in field.split(","):
+        if part == "":
+            raise ValueError(f"Empty value in cron field {field}")
+        value_range, _, step = part.partition("/")
+        step = _parse_value(step, {}) if step else 1
+        if step < 1:
+            raise ValueError(f"Invalid step in cron field {field}")
+        if value_range == "*":
+            start, end = low, high
+        elif "-" in value_range:
+            start, end = (_parse_value(value, names) for value in value_range.split("-", 1))
+            # "mon-sun" means 1-7
+            if index == 4 and end == 0 and start > end:
+                end = 7
+        else:
+            start = _parse_value(value_range, names)
+            # "5/15" means 5-59/15
+            end = high if "/" in part else start
+        if start > end or start < low or end > high:
+            raise ValueError(f"Value out of range in cron field {field}")
+        for value in range(start, end + 1, step):
+            mask |= 1 << value
+    if index == 4:
+        # Sunday can be written as 0 or 7
+        if mask & (1 << 7):
+            mask = (mask | 1) & ~(1 << 7)
+        high = 6
+    full = sum(1 << value for value in range(low, high + 1))
+    return mask, mask == full
+
+def _next_bit(mask: int, start: int, end: int):
+    # Smallest set bit in mask between start and end or None
+    mask >>= start
+    value = start
+    while mask and value <= end:
+        if mask & 1:
+            return value
+        mask >>= 1
+        value += 1
+    return None
+
+
+class CronSchedule:
+    def __init__(self, expression: str):
+        self.expression = expression
+        fields = ALIASES.get(expression.strip().lower(), expression).split()
+        if len(fields) not in (5, 6):
+            raise ValueError(f"Cron expression {expression} must have 5 or 6 fields")
+        self.has_seconds = len(fields) == 6
+        if not self.has_seconds:
+            fields.append("0")
+        parsed = [_parse_field(field, index) for index, field in enumerate(fields)]
+        self.minutes, self.hours, self.days, self.months, self.weekdays, self.seconds = (mask for mask, _ in parsed)
+        days_restricted = not parsed[2][1]
+        weekdays_restricted = not parsed[4][1]
+        # cron ORs day of month and day of week when both are restricted
+        self.day_or = days_restricted and weekdays_restricted
+        self.step = timedelta(seconds=1) if self.has_seconds else timedelta(minutes=1)
+
+    def _day_matches(self, t: datetime):
+        day = self.days >> t.day & 1
+        weekday = self.weekdays >> ((t.weekday() + 1) % 7) & 1
+        if self.day_or:
+            return bool(day or weekday)
+        return bool(day and weekday)
+
+    def matches(self, t: datetime):
+        return bool(
+            t.microsecond == 0
+            and self.seconds >> t.second & 1
+            and self.minutes >> t.minute & 1
+            and self.hours >> t.hour & 1
+            and self.months >> t.month & 1
+            and self._day_matches(t)
+        )
+
+    def next_after(self, t: datetime):
+        # First fire time strictly after t
+        if self.has_seconds:
+            t = t.replace(microsecond=0) + self.step
+        else:
+            t = t.replace(second=0, microsecond=0) + self.step
+        limit = t.year + MAX_YEARS
+        while t.year <= limit:
+            month = _next_bit(self.months, t.month, 12)
+            if month == None:
+                t = datetime(t.year + 1, 1, 1, tzinfo=t.tzinfo)
+                continue
+            if month != t.month:
+                t = datetime(t.year, month, 1, tzinfo=t.tzinfo)
+            if not self._day_matches(t):
+                t = t.replace(hour=0, minute=0, second=0) + timedelta(days=1)
+                continue
+            hour = _next_bit(self.hours, t.hour, 23)
+            if hour == None:
+                t = t.replace(hour=0, minute=0, second=0) + timedelta(days=1)
+                continue
+            if hour != t.hour:
+                t = t.replace(hour=hour, minute=0, second=0)
+            minute = _next_bit(self.minutes, t.minute, 59)
+            if minute == None:
+                t = t.replace(minute=0, second=0) + timedelta(hours=1)
+                continue
+            if minute != t.minute:
+                t = t.replace(minute=minute, second=0)
+            second = _next_bit(self.seconds, t.second, 59)
+            if second == None:
+                t = t.replace(second=0) + timedelta(minutes=1)
+                continue
+            return t.replace(second=second)
+        raise ValueError(f"Cron expression {self.expression} has no fire time within {MAX_YEARS} years")
+
+    def between(self, start: datetime, end: datetime):
+        # All fire times in [start, end]
+        fire_times = []
+        t = self.next_after(start - timedelta(microseconds=1))
+        while t <= end:
+            fire_times.append(t)
+            t = self.next_after(t)
+        return fire_times
+
+
+class CroniterSchedule:
+    # Fallback for expressions CronSchedule does not support
+    def __init__(self, expression: str):
+        self.expression = expression
+        croniter.croniter(expression)
+
+    def matches(self, t: datetime):
+        return croniter.croniter.match(self.expression, t)
+
+    def next_after(self, t: datetime):
+        return croniter.croniter(self.expression, t).get_next(datetime)
+
+    def between(self, start: datetime, end: datetime):
+        return list(croniter.croniter_range(start, end, self.expression))
+
+
+@lru_cache(maxsize=1024)
+def compile_cron(expression: str):
+    # Compiled schedules are cached by expression and shared between posts
+    try:
+        return CronSchedule(expression)
+    except UnsupportedCronSyntax:
+        logger.debug(f"compile_cron: Falling back to croniter for {expression}")
+        return CroniterSchedule(expression)
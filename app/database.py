@@ -1,7 +1,14 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from .config import settings
+import asyncio
+import psycopg2
+import psycopg2.extensions
+
+import logging
+
+logger = logging.getLogger(__name__)
 
 SQLALCHEMY_DATABASE_URL = f'postgresql://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}'
 
@@ -20,4 +27,108 @@ def get_db():
 
 def get_db_():
     db = SessionLocal()
-    return db
\ No newline at end of file
+    return db
+
+# Postgres channel used to tell other clock-bot processes about changes
+NOTIFY_CHANNEL = "clock_bot"
+
+def notify(db, payload: str):
+    db.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": NOTIFY_CHANNEL, "payload": payload})
+    db.commit()
+
+def _connect():
+    conn = psycopg2.connect(SQLALCHEMY_DATABASE_URL, keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3)
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    return conn
+
+def _listen_connect():
+    conn = _connect()
+    with conn.cursor() as cursor:
+        cursor.execute(f"LISTEN {NOTIFY_CHANNEL};")
+    return conn
+
+async def listen(callback, on_connect=None):
+    # Keep a dedicated connection LISTENing on NOTIFY_CHANNEL and call callback(payload) for every notification.
+    # Reconnects with backoff. on_connect() is called every time LISTEN starts, including the first time, because
+    # notifications sent before it, or while the connection was down, were missed.
+    loop = asyncio.get_running_loop()
+    retry = 1
+    while True:
+        conn = None
+        try:
+            conn = await loop.run_in_executor(None, _listen_connect)
+            logger.info(f"listen: Listening on channel {NOTIFY_CHANNEL}")
+            if on_connect != None:
+                on_connect()
+            retry = 1
+            lost = loop.create_future()
+
+            def readable():
+                try:
+                    conn.poll()
+                except Exception as e:
+                    if not lost.done():
+                        lost.set_exception(e)
+                    return
+                while conn.notifies:
+                    callback(conn.notifies.pop(0).payload)
+
+            loop.add_reader(conn.fileno(), readable)
+            try:
+                await lost
+            finally:
+                loop.remove_reader(conn.fileno())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"listen: {e}")
+        finally:
+            if conn != None:
+                conn.close()
+        await asyncio.sleep(retry)
+        retry = min(retry * 2, 60)
+
+# Advisory lock of the one clock-bot process that uploads media and renders statuses ahead of their slot
+PREPARE_LOCK_ID = 7243612
+
+def _try_lock(conn, lock_id: int):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s);", (lock_id,))
+        return cursor.fetchone()[0]
+
+def _ping(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT 1;")
+
+async def hold_lock(lock_id: int, on_change, interval: float = 10.0):
+    # Keep trying to take the session advisory lock lock_id on a dedicated connection. on_change(True) is called once
+    # it is held, on_change(False) when the connection and with it the lock is lost. Reconnects with backoff.
+    loop = asyncio.get_running_loop()
+    retry = 1
+    while True:
+        conn = None
+        held = False
+        try:
+            conn = await loop.run_in_executor(None, _connect)
+            retry = 1
+            while True:
+                if not held:
+                    held = await loop.run_in_executor(None, _try_lock, conn, lock_id)
+                    if held:
+                        logger.info(f"hold_lock: Holding lock {lock_id}")
+                        on_change(True)
+                else:
+                    # The lock lasts as long as the connection
+                    await loop.run_in_executor(None, _ping, conn)
+                await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"hold_lock: {e}")
+        finally:
+            if held:
+                on_change(False)
+            if conn != None:
+                conn.close()
+        await asyncio.sleep(retry)
+        retry = min(retry * 2, 60)
@@ -0,0 +1,97 @@
+from datetime import datetime
+import asyncio
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+'''
+Concurrent dispatch of due posts
+
+Runs a handler for every due post at the same time, limited by a global concurrency cap and a cap per bot_token_id,
+and keeps track of the parallelism that was actually achieved. dispatch() waits for a batch, submit() starts one post
+in the background so the caller can go on without waiting for slow posts.
+'''
+
+class Dispatcher:
+    def __init__(self, max_concurrency: int, max_concurrency_per_bot: int):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_concurrency_per_bot = max(1, max_concurrency_per_bot)
+        self._global_limit = asyncio.Semaphore(self.max_concurrency)
+        self._bot_limits = {}
+        self._in_flight = 0
+        self._batch_peak = 0
+        self._busy_seconds = 0.0
+        self._background = set()
+        self.stats = {
+            "batches": 0,
+            "dispatched": 0,
+            "in_flight": 0,
+            "last_batch_at": None,
+            "last_batch_size": 0,
+            "last_batch_seconds": 0.0,
+            "last_batch_peak_parallelism": 0,
+            "last_batch_average_parallelism": 0.0,
+            "peak_parallelism": 0,
+            "submitted": 0,
+            "last_submitted_at": None,
+        }
+
+    def _bot_limit(self, bot_token_id):
+        if bot_token_id not in self._bot_limits:
+            self._bot_limits[bot_token_id] = asyncio.Semaphore(self.max_concurrency_per_bot)
+        return self._bot_limits[bot_token_id]
+
+    async def _run_one(self, post, handler):
+        # Take the per-bot slot first so one busy bot does not hold global slots while it waits
+        async with self._bot_limit(post.bot_token_id):
+            async with self._global_limit:
+                self._in_flight += 1
+                self.stats["in_flight"] = self._in_flight
+                self._batch_peak = max(self._batch_peak, self._in_flight)
+                self.stats["peak_parallelism"] = max(self.stats["peak_parallelism"], self._in_flight)
+                started = time.monotonic()
+                try:
+                    return await handler(post)
+                except Exception as e:
+                    logger.error(f"Dispatcher: Post {post.id} {e}")
+                finally:
+                    self._in_flight -= 1
+                    self.stats["in_flight"] = self._in_flight
+                    self._busy_seconds += time.monotonic() - started
+
+    async def dispatch(self, posts, handler):
+        # Run handler(post) for every post concurrently and wait for all of them
+        if not posts:
+            return []
+        self._batch_peak = 0
+        self._busy_seconds = 0.0
+        started = time.monotonic()
+        results = await asyncio.gather(*[self._run_one(post, handler) for post in posts])
+        elapsed = time.monotonic() - started
+        average = self._busy_seconds / elapsed if elapsed > 0 else float(self._batch_peak)
+        self.stats["batches"] += 1
+        self.stats["dispatched"] += len(posts)
+        self.stats["last_batch_at"] = datetime.now()
+        self.stats["last_batch_size"] = len(posts)
+        self.stats["last_batch_seconds"] = round(elapsed, 3)
+        self.stats["last_batch_peak_parallelism"] = self._batch_peak
+        self.stats["last_batch_average_parallelism"] = round(average, 2)
+        self.stats["peak_parallelism"] = max(self.stats["peak_parallelism"], self._batch_peak)
+        logger.info(f"Dispatcher: Dispatched {len(posts)} post(s) in {elapsed:.2f}s, peak parallelism {self._batch_peak}, average parallelism {average:.2f}")
+        return results
+
+    def submit(self, post, handler):
+        # Run handler(post) in the background under the same limits, without waiting for it
+        self.stats["submitted"] += 1
+        self.stats["last_submitted_at"] = datetime.now()
+        task = asyncio.create_task(self._run_one(post, handler))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    async def drain(self):
+        # Wait for everything started with submit() to finish
+        while self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
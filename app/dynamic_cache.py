@@ -0,0 +1,148 @@
+from .config import settings
+from . import http_client, circuit_breaker, json_path
+
+from collections import OrderedDict
+from urllib.parse import urlparse
+from fastapi import HTTPException, status
+import asyncio
+import aiohttp
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+'''
+Shared cache of {{dynamic: ...}} responses
+
+Responses are cached per URL, so posts that read the same endpoint in the same minute share one request. How long a
+response is fresh is up to the template ({{dynamic: url, key, ttl}}, dynamic_cache_ttl by default). A response that is
+no longer fresh is still served for up to dynamic_cache_stale seconds while it is refreshed in the background.
+Refreshes are conditional GETs (If-None-Match / If-Modified-Since), a 304 only renews the cached response.
+Concurrent requests for the same URL wait for one fetch. The least recently used URLs are dropped past
+dynamic_cache_size entries.
+
+Only the response text is kept, at most dynamic_max_body bytes, and each key path read from it is looked up once with
+json_path instead of parsing the whole response into Python objects.
+'''
+
+class CachedResponse:
+    def __init__(self, text: str, etag: str = None, last_modified: str = None):
+        self.text = text
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.monotonic()
+        # compiled key path -> value found in text
+        self.values = {}
+
+    def value(self, key: str):
+        # Value at key path in the response, json_path.MISSING if there is none
+        path = json_path.compile_key_path(key)
+        if path not in self.values:
+            self.values[path] = json_path.find(self.text, path)
+        return self.values[path]
+
+
+class ResponseCache:
+    def __init__(self):
+        # url -> CachedResponse, least recently used first
+        self._entries = OrderedDict()
+        # url -> task of the fetch running for it
+        self._in_flight = {}
+        self.stats = {
+            "hits": 0,
+            "stale": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "fetched": 0,
+            "revalidated": 0,
+            "errors": 0,
+        }
+
+    async def get(self, url: str, ttl: float = None):
+        # CachedResponse for url, at most ttl seconds old unless it is being refreshed
+        if ttl == None:
+            ttl = settings.dynamic_cache_ttl
+        entry = self._entries.get(url)
+        if entry != None:
+            self._entries.move_to_end(url)
+            age = time.monotonic() - entry.fetched_at
+            if age < ttl:
+                self.stats["hits"] += 1
+                return entry
+            if age < ttl + settings.dynamic_cache_stale:
+                self.stats["stale"] += 1
+                self._fetch(url)
+                return entry
+        self.stats["misses"] += 1
+        # Shielded so a caller that gives up does not cancel the fetch for everyone else
+        return await asyncio.shield(self._fetch(url))
+
+    def _fetch(self, url: str):
+        task = self._in_flight.get(url)
+        if task != None:
+            self.stats["coalesced"] += 1
+            return task
+        task = asyncio.create_task(self._request(url))
+        self._in_flight[url] = task
+        task.add_done_callback(lambda task: self._fetched(url, task))
+        return task
+
+    def _fetched(self, url: str, task: asyncio.Task):
+        if self._in_flight.get(url) is task:
+            del self._in_flight[url]
+        # Background refreshes have nobody waiting for them
+        if not task.cancelled() and task.exception() != None:
+            self.stats["errors"] += 1
+            logger.error(f"ResponseCache: {url} {getattr(task.exception(), 'detail', task.exception())}")
+
+    async def _request(self, url: str):
+        entry = self._entries.get(url)
+        headers = {}
+        if entry != None and entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry != None and entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        logger.debug(f"ResponseCache: Getting {url}")
+        # Each host gets its own timeout, bulkhead and circuit breaker so a slow or failing endpoint cannot hold up posting
+        async with circuit_breaker.guard(f"dynamic:{urlparse(url).netloc}", settings.dynamic_max_concurrency_per_host) as call, http_client.get_session().get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=settings.dynamic_timeout)) as response:
+            call.failed = response.status >= 500
+            if response.status == 304 and entry != None:
+                self.stats["revalidated"] += 1
+                entry.fetched_at = time.monotonic()
+            elif response.status != 200:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                    detail=f"API endpoint {url} returned {response.status}")
+            else:
+                text = await self._read(url, response)
+                self.stats["fetched"] += 1
+                entry = CachedResponse(text, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        # Stored again after a 304 too, the entry may have been evicted while the request was in flight
+        self._store(url, entry)
+        return entry
+
+    def _store(self, url: str, entry: CachedResponse):
+        self._entries[url] = entry
+        self._entries.move_to_end(url)
+        while len(self._entries) > settings.dynamic_cache_size:
+            self._entries.popitem(last=False)
+
+    async def _read(self, url: str, response: aiohttp.ClientResponse):
+        # Read the body in chunks and give up once it is larger than dynamic_max_body
+        if response.content_length != None and response.content_length > settings.dynamic_max_body:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                detail=f"API endpoint {url} response of {response.content_length} bytes is too large")
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            body.extend(chunk)
+            if len(body) > settings.dynamic_max_body:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                    detail=f"API endpoint {url} response is larger than {settings.dynamic_max_body} bytes")
+        return body.decode(response.charset or "utf-8")
+
+    def status(self):
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "in_flight": len(self._in_flight),
+        }
@@ -0,0 +1,38 @@
+from .config import settings
+
+import aiohttp
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+'''
+Shared HTTP client
+
+One long-lived aiohttp.ClientSession for every Mastodon and dynamic content request, so connections are kept alive
+and reused instead of paying a TCP and TLS handshake per request. Connections are pooled per host and DNS lookups
+are cached. The session is created on first use and closed by close_session() on shutdown.
+'''
+
+session = None
+
+def get_session():
+    global session
+    if session == None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=settings.http_pool_size,
+            limit_per_host=settings.http_pool_size_per_host,
+            ttl_dns_cache=settings.http_dns_cache_ttl,
+            keepalive_timeout=settings.http_keepalive_timeout,
+        )
+        timeout = aiohttp.ClientTimeout(total=settings.http_timeout, connect=settings.http_connect_timeout)
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        logger.debug("get_session: Created shared HTTP session")
+    return session
+
+async def close_session():
+    global session
+    if session != None and not session.closed:
+        await session.close()
+        logger.debug("close_session: Closed shared HTTP session")
+    session = None
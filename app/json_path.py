@@ -0,0 +1,115 @@
+from functools import lru_cache
+import json
+import re
+
+'''
+Key path lookups in JSON text
+
+A key path like "stats.user_count", "data.0.name" or "items[2].title" is compiled once into a tuple of object keys
+and list indices. find() walks the JSON text along that path and decodes only the value it ends on: everything
+before it is skipped without being parsed into Python objects, and nothing after it is read. A large response costs
+its text, not a full object tree, when one value is wanted from it.
+'''
+
+MISSING = object()
+
+KEY_PATH_PART = re.compile(r'[^.\[\]]+')
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+# Next character that opens or closes a string or container
+STRUCTURE = re.compile(r'["{}\[\]]')
+# Rest of a string after its opening quote
+STRING_REST = re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL)
+# Number, true, false or null
+SCALAR = re.compile(r'[^\s,\]}]+')
+
+decoder = json.JSONDecoder()
+
+
+@lru_cache(maxsize=1024)
+def compile_key_path(key: str):
+    # "items[2].title" -> ("items", 2, "title"), digits are list indices
+    return tuple(int(part) if part.isdigit() else part for part in KEY_PATH_PART.findall(key))
+
+def _skip_whitespace(text: str, index: int):
+    return WHITESPACE.match(text, index).end()
+
+def _skip_string(text: str, index: int):
+    # index is the opening quote
+    match = STRING_REST.match(text, index + 1)
+    if match == None:
+        raise ValueError(f"Unterminated string at {index}")
+    return match.end()
+
+def _skip_value(text: str, index: int):
+    # Index after the value starting at index
+    if text[index] == '"':
+        return _skip_string(text, index)
+    if text[index] in "{[":
+        depth = 0
+        while True:
+            match = STRUCTURE.search(text, index)
+            if match == None:
+                raise ValueError("Unterminated object or array")
+            index = match.start()
+            if text[index] == '"':
+                index = _skip_string(text, index)
+                continue
+            depth += 1 if text[index] in "{[" else -1
+            index += 1
+            if depth == 0:
+                return index
+    match = SCALAR.match(text, index)
+    if match == None:
+        raise ValueError(f"Expected a value at {index}")
+    return match.end()
+
+def _find_member(text: str, index: int, part):
+    # index is the opening brace, returns the index of part's value or MISSING
+    index = _skip_whitespace(text, index + 1)
+    if text[index] == "}":
+        return MISSING
+    while True:
+        if text[index] != '"':
+            raise ValueError(f"Expected a key at {index}")
+        key, index = json.decoder.scanstring(text, index + 1)
+        index = _skip_whitespace(text, index)
+        if text[index] != ":":
+            raise ValueError(f"Expected ':' at {index}")
+        index = _skip_whitespace(text, index + 1)
+        if key == str(part):
+            return index
+        index = _skip_whitespace(text, _skip_value(text, index))
+        if text[index] != ",":
+            return MISSING
+        index = _skip_whitespace(text, index + 1)
+
+def _find_item(text: str, index: int, part: int):
+    # index is the opening bracket, returns the index of item part or MISSING
+    index = _skip_whitespace(text, index + 1)
+    if text[index] == "]":
+        return MISSING
+    position = 0
+    while position < part:
+        index = _skip_whitespace(text, _skip_value(text, index))
+        if text[index] != ",":
+            return MISSING
+        index = _skip_whitespace(text, index + 1)
+        position += 1
+    return index
+
+def find(text: str, path: tuple):
+    # Value at path in the JSON text or MISSING, raises ValueError for malformed JSON on the way
+    try:
+        index = _skip_whitespace(text, 0)
+        for part in path:
+            if text[index] == "{":
+                index = _find_member(text, index, part)
+            elif text[index] == "[" and isinstance(part, int):
+                index = _find_item(text, index, part)
+            else:
+                return MISSING
+            if index is MISSING:
+                return MISSING
+        return decoder.raw_decode(text, index)[0]
+    except IndexError:
+        raise ValueError("Unexpected end of JSON")
@@ -0,0 +1,92 @@
+from .database import get_db
+from . import models
+
+from fastapi import HTTPException, status
+import random
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+'''
+In-memory index of list contents
+
+{{list_random: ...}} and {{list_static: ...}} read lists from here instead of the database. A list is loaded with one
+query the first time it is used and kept as a tuple of contents (for random.choice) and a dict of item_id -> content.
+The lists router drops a list from the index after every change, in this process directly and in other processes
+through the "list:<id>" NOTIFY payload. Everything is dropped whenever the NOTIFY listener connects, including the
+first time, since changes made before that were missed.
+'''
+
+class IndexedList:
+    def __init__(self, rows):
+        self.contents = tuple(content for item_id, content in rows)
+        self.items = {}
+        for item_id, content in rows:
+            self.items.setdefault(item_id, content)
+
+
+class ListIndex:
+    def __init__(self):
+        # list_id -> IndexedList, None for lists that do not exist
+        self._lists = {}
+        self.stats = {
+            "hits": 0,
+            "loads": 0,
+            "invalidated": 0,
+        }
+
+    def _load(self, list_id: int):
+        with get_db() as db:
+            rows = db.query(models.ListContent.item_id, models.ListContent.content).filter(models.ListContent.list_id == list_id).all()
+            if not rows and not db.query(models.List.id).filter(models.List.id == list_id).first():
+                return None
+        return IndexedList(rows)
+
+    def get(self, list_id: int):
+        if list_id in self._lists:
+            self.stats["hits"] += 1
+            return self._lists[list_id]
+        logger.debug(f'ListIndex: Loading list content from database for list ID {str(list_id)}')
+        self.stats["loads"] += 1
+        self._lists[list_id] = self._load(list_id)
+        return self._lists[list_id]
+
+    def _contents(self, list_id: int):
+        indexed_list = self.get(list_id)
+        if indexed_list == None:
+            logger.error(f'List with ID {str(list_id)} was not found.')
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"List with ID {str(list_id)} was not found.")
+        return indexed_list
+
+    def random_item(self, list_id: int):
+        indexed_list = self._contents(list_id)
+        if not indexed_list.contents:
+            logger.error(f'List with ID {str(list_id)} has no content.')
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"List with ID {str(list_id)} has no content.")
+        return random.choice(indexed_list.contents)
+
+    def item(self, list_id: int, item_id: int):
+        indexed_list = self._contents(list_id)
+        if item_id not in indexed_list.items:
+            logger.error(f'Item with ID {str(item_id)} was not found in list with ID {str(list_id)}.')
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"Item with ID {str(item_id)} was not found in list with ID {str(list_id)}.")
+        return indexed_list.items[item_id]
+
+    def invalidate(self, list_id: int = None):
+        # Drop one list, or every list if list_id is None
+        if list_id == None:
+            self.stats["invalidated"] += len(self._lists)
+            self._lists.clear()
+        elif self._lists.pop(list_id, False) != False:
+            self.stats["invalidated"] += 1
+
+    def status(self):
+        return {
+            **self.stats,
+            "lists": len(self._lists),
+            "items": sum(len(indexed_list.contents) for indexed_list in self._lists.values() if indexed_list != None),
+        }
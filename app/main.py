@@ -37,6 +37,7 @@ Posts:
   - {{list_static: 1,1}} to select the first item from a list_id of 1 and item_id of 1. When creating lists, item_id is a custom integer but must be unique.
   - {{dynamic: https://stranger.social/api/v1/instance, stats.user_count}} to get an API JSON response from a URL and select a key from the response.
 - media_path is the path to the media file on the bot server. e.g. /usr/src/app/media/image.jpg
+- media is a list of up to 4 attachments (including media_path) with media_path, description and focus_x/focus_y from -1.0 to 1.0.
 
 
 Lists:
@@ -79,17 +80,32 @@ app.include_router(list.router)
 app.include_router(admin.router)
 app.include_router(auth.router)
 
+scheduler_task = None
+
 @app.on_event("startup")
 async def startup_event():
     # Start clock-bot
     logger.debug("clock-bot debug mode")
+    if not settings.embedded_scheduler:
+        logger.info("clock-bot embedded scheduler disabled, run python -m app.worker to post statuses")
+        return
+    global scheduler_task
+    scheduler_task = asyncio.create_task(clock_bot.clock_bot_main())
     background_tasks = BackgroundTasks()
-    await clock_bot.clear_next_run()
-    background_tasks.add_task(asyncio.create_task(clock_bot.clock_bot_main()))
+    background_tasks.add_task(scheduler_task)
     # List background tasks in debug mode
     logger.debug(f"background_tasks: {background_tasks}")
     logger.info("clock-bot started")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Stop the scheduler first so nothing is still posting once buffered writes are flushed
+    if scheduler_task != None:
+        scheduler_task.cancel()
+        await asyncio.gather(scheduler_task, return_exceptions=True)
+    await clock_bot.shutdown()
+    logger.info("clock-bot stopped")
+
 @app.get("/")
 async def root():
     return {"message": "clock-bot API"}
\ No newline at end of file
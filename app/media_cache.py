@@ -0,0 +1,130 @@
+from .config import settings
+
+from typing import NamedTuple, Optional
+import asyncio
+import hashlib
+import magic
+import os
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+'''
+Content-addressed cache of uploaded Mastodon media
+
+Uploaded media is keyed by (sha256 of the file, bot_token_id, description, focus). The file hash and MIME type are kept per
+media_path and only recomputed, in a thread, when the file's mtime or size changes.
+
+Mastodon only attaches media that is not attached to a status yet, so a media_id can be used once. The cache is a
+pool of processed, unattached media_ids: take() hands one out and removes it, put() returns an id that was not used
+(e.g. the status was never sent) or adds one uploaded ahead of time. Mastodon removes unattached media after a day,
+ids older than media_cache_ttl are dropped.
+'''
+
+class Attachment(NamedTuple):
+    media_path: str
+    description: Optional[str] = None
+    # "x,y" focal point
+    focus: Optional[str] = None
+
+
+class MediaKey(NamedTuple):
+    sha256: str
+    bot_token_id: int
+    description: Optional[str] = None
+    focus: Optional[str] = None
+
+
+class MediaCache:
+    def __init__(self):
+        # media_path -> ((mtime_ns, size), sha256) and ((mtime_ns, size), mime type)
+        self._file_hashes = {}
+        self._mime_types = {}
+        # MediaKey -> [(media_id, cached_at)], oldest first
+        self._media_ids = {}
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "hashed": 0,
+            "expired": 0,
+        }
+
+    async def _file_version(self, media_path: str):
+        file_stat = await asyncio.to_thread(os.stat, media_path)
+        return file_stat.st_mtime_ns, file_stat.st_size
+
+    def _detect_mime_type(self, media_path: str):
+        with open(media_path, "rb") as media:
+            return magic.from_buffer(media.read(2048), mime=True)
+
+    async def mime_type(self, media_path: str):
+        # MIME type of media_path, detected in a thread only when the file changed
+        version = await self._file_version(media_path)
+        cached = self._mime_types.get(media_path)
+        if cached != None and cached[0] == version:
+            return cached[1]
+        media_mime_type = await asyncio.to_thread(self._detect_mime_type, media_path)
+        self._mime_types[media_path] = (version, media_mime_type)
+        return media_mime_type
+
+    def _hash_file(self, media_path: str):
+        digest = hashlib.sha256()
+        with open(media_path, "rb") as media:
+            for chunk in iter(lambda: media.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    async def file_hash(self, media_path: str):
+        # sha256 of media_path, rehashed in a thread only when the file changed
+        version = await self._file_version(media_path)
+        cached = self._file_hashes.get(media_path)
+        if cached != None and cached[0] == version:
+            return cached[1]
+        sha256 = await asyncio.to_thread(self._hash_file, media_path)
+        self.stats["hashed"] += 1
+        if cached != None and cached[1] != sha256:
+            # The file was replaced, ids uploaded from the old content are no use to this path any more
+            logger.debug(f"MediaCache: {media_path} changed")
+        self._file_hashes[media_path] = (version, sha256)
+        return sha256
+
+    async def key(self, attachment: Attachment, bot_token_id: int):
+        return MediaKey(await self.file_hash(attachment.media_path), bot_token_id, attachment.description, attachment.focus)
+
+    def _expire(self, key: MediaKey):
+        oldest = time.time() - settings.media_cache_ttl
+        media_ids = [item for item in self._media_ids.get(key, []) if item[1] >= oldest]
+        self.stats["expired"] += len(self._media_ids.get(key, [])) - len(media_ids)
+        if media_ids:
+            self._media_ids[key] = media_ids
+        else:
+            self._media_ids.pop(key, None)
+
+    def take(self, key: MediaKey):
+        # Remove and return a cached media_id for key or None
+        self._expire(key)
+        if key not in self._media_ids:
+            self.stats["misses"] += 1
+            return None
+        media_id, cached_at = self._media_ids[key].pop(0)
+        if not self._media_ids[key]:
+            del self._media_ids[key]
+        self.stats["hits"] += 1
+        return media_id
+
+    def put(self, key: MediaKey, media_id: str, cached_at: float = None):
+        # Add an unattached, processed media_id for key
+        self._media_ids.setdefault(key, []).append((media_id, cached_at or time.time()))
+
+    def available(self, key: MediaKey):
+        self._expire(key)
+        return len(self._media_ids.get(key, []))
+
+    def status(self):
+        return {
+            **self.stats,
+            "files": len(self._file_hashes),
+            "media_ids": sum(len(media_ids) for media_ids in self._media_ids.values()),
+        }
@@ -1,5 +1,5 @@
 from csv import unregister_dialect
-from sqlalchemy import TIMESTAMP, Column, ForeignKey, Integer, String, Boolean
+from sqlalchemy import TIMESTAMP, Column, ForeignKey, Integer, String, Boolean, Float, UniqueConstraint
 from sqlalchemy.sql.expression import text
 from sqlalchemy.sql.sqltypes import TIMESTAMP
 from sqlalchemy.orm import relationship
@@ -23,6 +23,9 @@ class Post(Base):
     bot_token_id = Column(Integer, ForeignKey("bot_tokens.id", ondelete="CASCADE"), nullable=True)
     bot_token = relationship("BotToken", back_populates="post")
     media_path = Column(String, nullable=True)
+    jitter_seconds = Column(Integer, nullable=True)
+    # Loaded with the post so it can be used after the session is closed
+    media = relationship("PostMedia", order_by="PostMedia.position", lazy="selectin", cascade="all, delete-orphan")
 
 class User(Base):
     __tablename__ = "users"
@@ -48,6 +51,7 @@ class BotToken(Base):
     id = Column(Integer, primary_key=True, nullable=False)
     token = Column(String, nullable=False)
     description = Column(String, nullable=True)
+    jitter_seconds = Column(Integer, nullable=True)
     post = relationship("Post", back_populates="bot_token")
 
 class List(Base):
@@ -66,4 +70,45 @@ class ListContent(Base):
     item_id = Column(Integer, nullable=False)
     content = Column(String(255), nullable=False)
     date_added = Column(TIMESTAMP(timezone=False), nullable=False, server_default=text('now()'))
-    date_last_used = Column(TIMESTAMP(timezone=False), nullable=True)
\ No newline at end of file
+    date_last_used = Column(TIMESTAMP(timezone=False), nullable=True)
+
+class Outbox(Base):
+    __tablename__ = "outbox"
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    post_id = Column(Integer, ForeignKey("posts.id", ondelete="CASCADE"), nullable=False)
+    bot_token_id = Column(Integer, ForeignKey("bot_tokens.id", ondelete="CASCADE"), nullable=False)
+    # Rendered JSON body for POST /api/v1/statuses
+    payload = Column(String, nullable=False)
+    idempotency_key = Column(String, nullable=False, unique=True)
+    # pending or failed, delivered statuses are deleted
+    status = Column(String, nullable=False, server_default="pending")
+    attempts = Column(Integer, nullable=False, server_default="0")
+    next_attempt = Column(TIMESTAMP(timezone=False), nullable=False, server_default=text('now()'))
+    last_error = Column(String, nullable=True)
+    created_at = Column(TIMESTAMP(timezone=False), nullable=False, server_default=text('now()'))
+
+class ScheduledStatus(Base):
+    __tablename__ = "scheduled_statuses"
+    __table_args__ = (UniqueConstraint("post_id", "scheduled_at"),)
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    post_id = Column(Integer, ForeignKey("posts.id", ondelete="CASCADE"), nullable=False)
+    bot_token_id = Column(Integer, ForeignKey("bot_tokens.id", ondelete="CASCADE"), nullable=False)
+    # The post's cron slot, Mastodon publishes the status at the slot plus the post's jitter
+    scheduled_at = Column(TIMESTAMP(timezone=False), nullable=False)
+    # Id of the scheduled status on Mastodon, Null while it is being created
+    scheduled_status_id = Column(String, nullable=True)
+    created_at = Column(TIMESTAMP(timezone=False), nullable=False, server_default=text('now()'))
+
+class PostMedia(Base):
+    __tablename__ = "post_media"
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    post_id = Column(Integer, ForeignKey("posts.id", ondelete="CASCADE"), nullable=False)
+    position = Column(Integer, nullable=False, default=0)
+    media_path = Column(String, nullable=False)
+    description = Column(String, nullable=True)
+    # Focal point from -1.0 to 1.0, see https://docs.joinmastodon.org/api/guidelines/#focal-points
+    focus_x = Column(Float, nullable=True)
+    focus_y = Column(Float, nullable=True)
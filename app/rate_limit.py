@@ -0,0 +1,117 @@
+from .config import settings
+
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+import asyncio
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+'''
+Mastodon rate limits per bot token
+
+Mastodon sends X-RateLimit-Limit, X-RateLimit-Remaining and X-RateLimit-Reset on every API response.
+Each bot token gets one bucket per kind of request ("default" for statuses and other API calls, "media" for uploads,
+which Mastodon budgets separately). Buckets learn from those headers and hold requests back before the limit
+is reached instead of running into 429 responses.
+'''
+
+# Mastodon defaults, used until the first response headers are seen: (limit, period in seconds)
+DEFAULT_LIMITS = {
+    "default": (300, 300),
+    "media": (30, 1800),
+}
+
+
+class RateLimitBucket:
+    def __init__(self, bot_token_id, kind: str):
+        self.bot_token_id = bot_token_id
+        self.kind = kind
+        self.limit, self.period = DEFAULT_LIMITS.get(kind, DEFAULT_LIMITS["default"])
+        self.remaining = self.limit
+        self.reset_at = None
+        self.in_flight = 0
+        self.waits = 0
+        self.throttled = 0
+        # Waiting requests are let through in arrival order
+        self._lock = asyncio.Lock()
+
+    def _refill(self, current_time: datetime):
+        if self.reset_at != None and current_time >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = None
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                current_time = datetime.now(timezone.utc)
+                self._refill(current_time)
+                if self.remaining > settings.rate_limit_reserve:
+                    break
+                if self.reset_at == None:
+                    self.reset_at = current_time + timedelta(seconds=self.period)
+                wait = max((self.reset_at - current_time).total_seconds(), 0.05)
+                self.waits += 1
+                logger.warning(f"RateLimitBucket: Bot token {self.bot_token_id} {self.kind} budget exhausted, waiting {wait:.1f}s")
+                await asyncio.sleep(wait)
+            if self.reset_at == None:
+                self.reset_at = datetime.now(timezone.utc) + timedelta(seconds=self.period)
+            self.remaining -= 1
+            self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+
+    def update(self, response):
+        # Learn the budget from a response. Requests still in flight are not counted by the server yet.
+        headers = response.headers
+        try:
+            if "X-RateLimit-Limit" in headers:
+                self.limit = int(headers["X-RateLimit-Limit"])
+            if "X-RateLimit-Remaining" in headers:
+                self.remaining = int(headers["X-RateLimit-Remaining"]) - (self.in_flight - 1)
+            if "X-RateLimit-Reset" in headers:
+                self.reset_at = datetime.fromisoformat(headers["X-RateLimit-Reset"].replace("Z", "+00:00"))
+                if self.reset_at.tzinfo == None:
+                    self.reset_at = self.reset_at.replace(tzinfo=timezone.utc)
+        except ValueError as e:
+            logger.error(f"RateLimitBucket: Bot token {self.bot_token_id} could not read rate limit headers: {e}")
+        if response.status == 429:
+            self.throttled += 1
+            self.remaining = 0
+            logger.warning(f"RateLimitBucket: Bot token {self.bot_token_id} {self.kind} rate limited until {self.reset_at}")
+
+    def budget(self):
+        self._refill(datetime.now(timezone.utc))
+        return {
+            "bot_token_id": self.bot_token_id,
+            "kind": self.kind,
+            "limit": self.limit,
+            "remaining": max(self.remaining, 0),
+            "reset_at": self.reset_at,
+            "in_flight": self.in_flight,
+            "waits": self.waits,
+            "throttled": self.throttled,
+        }
+
+
+buckets = {}
+
+def get_bucket(bot_token_id, kind: str = "default"):
+    if (bot_token_id, kind) not in buckets:
+        buckets[(bot_token_id, kind)] = RateLimitBucket(bot_token_id, kind)
+    return buckets[(bot_token_id, kind)]
+
+@asynccontextmanager
+async def slot(bot_token_id, kind: str = "default"):
+    # Wait for budget, then call bucket.update(response) inside the block
+    bucket = get_bucket(bot_token_id, kind)
+    await bucket.acquire()
+    try:
+        yield bucket
+    finally:
+        bucket.release()
+
+def budgets():
+    return [bucket.budget() for bucket in buckets.values()]
@@ -1,8 +1,8 @@
 from typing import List, Optional
 
-from app import oauth2, clock_bot
+from app import oauth2, clock_bot, rate_limit, circuit_breaker
 from .. import models, schemas, oauth2
-from fastapi import APIRouter, HTTPException, Response, status, Depends
+from fastapi import APIRouter, HTTPException, Response, status, Depends, Query
 from sqlalchemy.orm import Session
 from ..database import get_db
 
@@ -40,6 +40,8 @@ async def create_bot_token(token: schemas.BotTokenCreate, db: Session = Depends(
         db.add(db_token)
         db.commit()
         db.refresh(db_token)
+        # The bot's jitter_seconds is resolved into every scheduled post when it is loaded, reload them all
+        clock_bot.notify_schedule_change(db, "*")
         return db_token
 
 @router.get("/tokens/{token_id}", response_model=schemas.BotTokenResponse, description="Get a bot token by id [must be logged in]")
@@ -67,8 +69,11 @@ async def update_bot_token(token_id: int, token: schemas.BotTokenCreate, db: Ses
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Token with id {token_id} not found")
         db_token.description = token.description
         db_token.token = token.token
+        db_token.jitter_seconds = token.jitter_seconds
         db.commit()
         db.refresh(db_token)
+        # The bot's jitter_seconds is resolved into every scheduled post when it is loaded, reload them all
+        clock_bot.notify_schedule_change(db, "*")
         return db_token
 
 @router.delete("/tokens/{token_id}", status_code=status.HTTP_204_NO_CONTENT, description="Delete a bot token by id [must be logged in]")
@@ -85,6 +90,53 @@ async def delete_bot_token(token_id: int, db: Session = Depends(get_db), current
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Token with id {token_id} not found")
         db.delete(db_token)
         db.commit()
+        clock_bot.notify_schedule_change(db, "*")
         return Response(status_code=status.HTTP_204_NO_CONTENT)
 
-        
\ No newline at end of file
+        
+
+@router.get("/status", description="Get scheduler status and dispatch statistics [must be logged in]")
+async def get_bot_status(current_user: int = Depends(oauth2.get_current_user)):
+    if not current_user.is_active:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail=f"User {str(current_user.username)} is not active.")
+    else:
+        return clock_bot.scheduler_status()
+
+@router.get("/load", description="Get the number of scheduled posts firing in each second of the minute [must be logged in]")
+async def get_bot_load(bucket_seconds: int = 1, current_user: int = Depends(oauth2.get_current_user)):
+    if not current_user.is_active:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail=f"User {str(current_user.username)} is not active.")
+    if bucket_seconds < 1 or 60 % bucket_seconds != 0:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"bucket_seconds must divide 60")
+    else:
+        return {"bucket_seconds": bucket_seconds, "histogram": clock_bot.schedule_queue.load_histogram(bucket_seconds)}
+
+@router.get("/rate-limits", description="Get the Mastodon rate limit budget of each bot token [must be logged in]")
+async def get_bot_rate_limits(current_user: int = Depends(oauth2.get_current_user)):
+    if not current_user.is_active:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail=f"User {str(current_user.username)} is not active.")
+    else:
+        return rate_limit.budgets()
+
+@router.get("/circuits", description="Get the circuit breaker state of the Mastodon instance and every dynamic source [must be logged in]")
+async def get_bot_circuits(current_user: int = Depends(oauth2.get_current_user)):
+    if not current_user.is_active:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail=f"User {str(current_user.username)} is not active.")
+    else:
+        return circuit_breaker.circuits()
+
+@router.get("/outbox", response_model=List[schemas.OutboxResponse], description="Get statuses waiting for delivery or failed, filter with status=pending or status=failed [must be logged in]")
+async def get_bot_outbox(db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user), status_filter: Optional[str] = Query(None, alias="status"), limit: int = 100):
+    if not current_user.is_active:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail=f"User {str(current_user.username)} is not active.")
+    else:
+        outbox_query = db.query(models.Outbox)
+        if status_filter != None:
+            outbox_query = outbox_query.filter(models.Outbox.status == status_filter)
+        return outbox_query.order_by(models.Outbox.next_attempt).limit(limit).all()
\ No newline at end of file
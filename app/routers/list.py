@@ -1,7 +1,7 @@
 from typing import List, Optional
 
 from app import oauth2
-from .. import models, schemas, oauth2
+from .. import models, schemas, oauth2, clock_bot
 from fastapi import APIRouter, HTTPException, Response, status, Depends
 from sqlalchemy.orm import Session
 from ..database import get_db
@@ -37,6 +37,7 @@ async def create_lists(list: schemas.ListCreate, db: Session = Depends(get_db),
         db.add(db_list)
         db.commit()
         db.refresh(db_list)
+        clock_bot.notify_list_change(db, db_list.id)
         return db_list
 
 @router.get("/{id}", response_model=schemas.ListResponse, description="Get list by id [must be logged in]")
@@ -79,6 +80,7 @@ async def delete_list_by_id(id: int, db: Session = Depends(get_db), current_user
                                 detail=f"List with ID {str(id)} was not found.")
         db.delete(db_list)
         db.commit()
+        clock_bot.notify_list_change(db, id)
         return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 ''' LIST CONTENT ENDPOINTS
@@ -114,6 +116,7 @@ async def create_list_items(id: int, list_item: schemas.ListContentCreate, db: S
             db.add(db_list_item)
             db.commit()
             db.refresh(db_list_item)
+            clock_bot.notify_list_change(db, id)
             return db_list_item
 
 @router.get("/{id}/items/{item_id}", response_model=schemas.ListContentResponse, description="Get list item by id [must be logged in]")
@@ -143,6 +146,7 @@ async def update_list_item_by_id(id: int, item_id: int, list_item: schemas.ListC
         db_list_item.item_id = list_item.item_id
         db.commit()
         db.refresh(db_list_item)
+        clock_bot.notify_list_change(db, id)
         return db_list_item
         
 @router.delete("/{id}/items/{item_id}", status_code=status.HTTP_204_NO_CONTENT, description="Delete list item by id [must be logged in]")
@@ -157,5 +161,6 @@ async def delete_list_item_by_id(id: int, item_id: int, db: Session = Depends(ge
                                 detail=f"List item with ID {str(item_id)} was not found.")
         db.delete(db_list_item)
         db.commit()
+        clock_bot.notify_list_change(db, id)
         return Response(status_code=status.HTTP_204_NO_CONTENT)
 
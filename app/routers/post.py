@@ -1,6 +1,6 @@
 from typing import List, Optional
 
-from app import oauth2
+from app import oauth2, clock_bot
 from .. import models, schemas, oauth2
 from fastapi import APIRouter, HTTPException, Response, status, Depends
 from sqlalchemy.orm import Session
@@ -27,10 +27,14 @@ async def create_posts(post: schemas.PostCreate, db: Session = Depends(get_db),
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail=f"User {str(current_user.username)} is not active.")
     else:
-        new_post = models.Post(owner_id=current_user.id , **post.dict())
+        post_data = post.dict()
+        media = post_data.pop("media")
+        new_post = models.Post(owner_id=current_user.id , **post_data)
+        new_post.media = [models.PostMedia(position=position, **attachment) for position, attachment in enumerate(media)]
         db.add(new_post)
         db.commit()
         db.refresh(new_post)
+        clock_bot.notify_schedule_change(db, new_post.id)
         return new_post
 
 
@@ -64,8 +68,11 @@ async def delete_post(id: int, response: Response, db: Session = Depends(get_db)
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                                 detail=f"Not authorized to perform requested action")
 
+        # Scheduled statuses are removed with the post, cancel them on Mastodon first
+        await clock_bot.cancel_scheduled_statuses(id)
         post_query.delete(synchronize_session=False)
         db.commit()
+        clock_bot.notify_schedule_change(db, id)
         return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
@@ -83,6 +90,11 @@ async def update_post(id: int, updated_post: schemas.PostCreate, response: Respo
         if post.owner_id != current_user.id:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                                 detail=f"Not authorized to perform requested action")
-        post_query.update(updated_post.dict(), synchronize_session=False)
+        post_data = updated_post.dict()
+        media = post_data.pop("media")
+        post_query.update(post_data, synchronize_session=False)
+        post.media = [models.PostMedia(position=position, **attachment) for position, attachment in enumerate(media)]
         db.commit()
+        await clock_bot.cancel_scheduled_statuses(id)
+        clock_bot.notify_schedule_change(db, id)
         return post_query.first()
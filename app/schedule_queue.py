@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+import heapq
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+'''
+In-memory scheduler index
+
+Holds one compact record per published post and keeps them in a min-heap keyed on fire time
+(next_run plus the post's jitter offset), so the clock-bot loop only has to look at posts that are actually due.
+'''
+
+class ScheduleEntry(NamedTuple):
+    post_id: int
+    next_run: Optional[datetime]
+    crontab_schedule: str
+    bot_token_id: Optional[int]
+    # seconds after next_run the post actually fires
+    jitter: float = 0.0
+    has_media: bool = False
+
+    @property
+    def fire_at(self):
+        if self.next_run == None:
+            return None
+        return self.next_run + timedelta(seconds=self.jitter)
+
+
+class ScheduleQueue:
+    def __init__(self):
+        # heap items are (fire_at, post_id, entry). Replaced or removed entries are left in the heap
+        # and skipped when popped (lazy deletion), _entries always holds the live record per post.
+        self._heap = []
+        self._entries = {}
+        # posts with a Null next_run waiting for their first next_run to be calculated
+        self._unscheduled = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, post_id):
+        return post_id in self._entries
+
+    def get(self, post_id):
+        return self._entries.get(post_id)
+
+    def push(self, entry: ScheduleEntry):
+        # Add or replace the record for entry.post_id
+        self._entries[entry.post_id] = entry
+        if entry.next_run == None:
+            self._unscheduled.add(entry.post_id)
+        else:
+            self._unscheduled.discard(entry.post_id)
+            heapq.heappush(self._heap, (entry.fire_at, entry.post_id, entry))
+            self._compact()
+
+    def remove(self, post_id):
+        self._unscheduled.discard(post_id)
+        return self._entries.pop(post_id, None)
+
+    def clear(self):
+        self._heap = []
+        self._entries = {}
+        self._unscheduled = set()
+
+    def unscheduled(self):
+        # Entries that still need a next_run
+        return [self._entries[post_id] for post_id in self._unscheduled]
+
+    def peek_next_run(self):
+        # Earliest fire time in the queue or None if the queue is empty
+        self._discard_stale()
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+    def upcoming(self, until: datetime):
+        # Entries firing at or before until without removing them. Walks the heap from the root and stops at
+        # items later than until, so only the upcoming part of the heap is visited.
+        upcoming = []
+        stack = [0]
+        while stack:
+            index = stack.pop()
+            if index >= len(self._heap) or self._heap[index][0] > until:
+                continue
+            fire_at, post_id, entry = self._heap[index]
+            if self._entries.get(post_id) is entry:
+                upcoming.append(entry)
+            stack.extend((2 * index + 1, 2 * index + 2))
+        return upcoming
+
+    def pop_due(self, current_time: datetime):
+        # Remove and return every entry firing at or before current_time, earliest first
+        due = []
+        while True:
+            self._discard_stale()
+            if not self._heap or self._heap[0][0] > current_time:
+                break
+            fire_at, post_id, entry = heapq.heappop(self._heap)
+            del self._entries[post_id]
+            due.append(entry)
+        return due
+
+    def _discard_stale(self):
+        while self._heap and self._entries.get(self._heap[0][1]) is not self._heap[0][2]:
+            heapq.heappop(self._heap)
+
+    def _compact(self):
+        # Rebuild the heap once stale items outnumber live ones
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [(entry.fire_at, entry.post_id, entry) for entry in self._entries.values() if entry.next_run != None]
+            heapq.heapify(self._heap)
+            logger.debug(f"ScheduleQueue: Compacted heap to {len(self._heap)} entries")
+
+    def load_histogram(self, bucket_seconds: int = 1):
+        # Number of scheduled posts firing in each bucket of the minute, used to check that jitter flattens peaks
+        buckets = [0] * (60 // bucket_seconds)
+        for entry in self._entries.values():
+            if entry.next_run != None:
+                fire_at = entry.fire_at
+                buckets[int(fire_at.second + fire_at.microsecond / 1000000) // bucket_seconds % len(buckets)] += 1
+        return buckets
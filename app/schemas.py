@@ -1,7 +1,19 @@
-from typing import Optional
-from pydantic import BaseModel, EmailStr, conint
+from typing import List, Optional
+from pydantic import BaseModel, EmailStr, conint, confloat, conlist, root_validator
 from datetime import datetime
 
+# Mastodon allows four attachments per status
+MAX_ATTACHMENTS = 4
+
+class PostMedia(BaseModel):
+    media_path: str
+    description: Optional[str] = None
+    focus_x: Optional[confloat(ge=-1.0, le=1.0)] = None
+    focus_y: Optional[confloat(ge=-1.0, le=1.0)] = None
+
+    class Config:
+        orm_mode = True
+
 class PostBase(BaseModel):
     content: str
     crontab_schedule: str = "*/5 * * * *"
@@ -11,6 +23,14 @@ class PostBase(BaseModel):
     published: bool = True
     bot_token_id: int = None
     media_path: str = None
+    jitter_seconds: Optional[conint(ge=0)] = None
+    media: conlist(PostMedia, max_items=MAX_ATTACHMENTS) = []
+
+    @root_validator(skip_on_failure=True)
+    def check_attachments(cls, values):
+        if values.get("media_path") and len(values.get("media") or []) >= MAX_ATTACHMENTS:
+            raise ValueError(f"A post can have at most {MAX_ATTACHMENTS} attachments including media_path")
+        return values
     
 
 class PostCreate(PostBase):
@@ -66,11 +86,13 @@ class ApiToken(BaseModel):
 class BotTokenCreate(BaseModel):
     token: str
     description: str = None
+    jitter_seconds: Optional[conint(ge=0)] = None
 
 class BotTokenResponse(BaseModel):
     id: int
     token: str
     description: str = None
+    jitter_seconds: Optional[int] = None
 
     class Config:
         orm_mode = True
@@ -122,5 +144,16 @@ class ListContentOut(BaseModel):
     class Config:
         orm_mode = True
 
+class OutboxResponse(BaseModel):
+    id: int
+    post_id: int
+    bot_token_id: int
+    payload: str
+    status: str
+    attempts: int
+    next_attempt: datetime
+    last_error: Optional[str] = None
+    created_at: datetime
 
-
+    class Config:
+        orm_mode = True
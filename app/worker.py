@@ -0,0 +1,46 @@
+import sys
+import signal
+import asyncio
+
+from .config import settings
+from app import clock_bot
+
+import logging
+
+# Set logging level to variable settings.logging_level
+logging.basicConfig(level=settings.logging_level)
+logger = logging.getLogger(__name__)
+
+# Configure the logger
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s in %(module)s: %(message)s"))
+logger.addHandler(handler)
+
+'''
+Standalone clock-bot scheduler worker
+
+Runs only the clock_bot loop, without the API. Start it with `python -m app.worker` and set
+EMBEDDED_SCHEDULER=False on the API so the two can be sized, restarted and profiled separately.
+'''
+
+async def main():
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop.set)
+
+    logger.info("clock-bot worker started")
+    scheduler_task = asyncio.create_task(clock_bot.clock_bot_main())
+    stop_task = asyncio.create_task(stop.wait())
+    await asyncio.wait({scheduler_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+    if scheduler_task.done() and scheduler_task.exception() != None:
+        logger.error(f"main: Scheduler stopped: {scheduler_task.exception()}")
+
+    scheduler_task.cancel()
+    stop_task.cancel()
+    await asyncio.gather(scheduler_task, stop_task, return_exceptions=True)
+    await clock_bot.shutdown()
+    logger.info("clock-bot worker stopped")
+
+if __name__ == "__main__":
+    asyncio.run(main())
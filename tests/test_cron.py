@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta
+
+import croniter
+import pytest
+
+from app.cron import CronSchedule, CroniterSchedule, compile_cron
+
+# Compiled schedules must fire exactly when croniter does
+EXPRESSIONS = [
+    "* * * * *",
+    "*/5 * * * *",
+    "5/15 * * * *",
+    "0 * * * *",
+    "30 9 * * *",
+    "0 22 * * *",
+    "0 9-17 * * 1-5",
+    "0 0 1 * *",
+    "0 0 31 * *",
+    "0 0 29 2 *",
+    "0 0 1,15 * mon",
+    "0 0 */2 * *",
+    "0 0 * * 0",
+    "0 0 * * 7",
+    "0 0 * * 5-7",
+    "0 0 * * 5-0",
+    "0 0 * * sat-sun",
+    "0 0 * * mon-sun",
+    "0 12 * jan-mar mon,wed,fri",
+    "15,45 */3 * * *",
+    "0 0 1 1 *",
+    "*/15 * * * * 30",
+    "0 0 * * * */20",
+    "@hourly",
+    "@daily",
+    "@weekly",
+    "@monthly",
+    "@yearly",
+]
+
+STARTS = [
+    datetime(2024, 1, 1, 0, 0, 0),
+    datetime(2024, 2, 28, 23, 59, 30),
+    datetime(2023, 12, 31, 23, 58, 59, 500000),
+    datetime(2024, 6, 15, 13, 7, 42),
+]
+
+# Rejected by croniter, must not compile
+INVALID = [
+    "0 0 * * fri-mon",
+    "0 0 * * 5-1",
+    "0 0 * nov-feb *",
+    "0 22-2 * * *",
+    "60 * * * *",
+    "0 24 * * *",
+    "0 0 0 * *",
+    "0 0 * 13 *",
+    "* * * *",
+    "*/0 * * * *",
+]
+
+
+def croniter_fire_times(expression, start, count):
+    iterator = croniter.croniter(expression, start)
+    return [iterator.get_next(datetime) for _ in range(count)]
+
+
+@pytest.mark.parametrize("expression", EXPRESSIONS)
+@pytest.mark.parametrize("start", STARTS)
+def test_next_after_matches_croniter(expression, start):
+    schedule = compile_cron(expression)
+    assert isinstance(schedule, CronSchedule)
+    expected = croniter_fire_times(expression, start, 20)
+    fire_times = []
+    t = start
+    for _ in range(20):
+        t = schedule.next_after(t)
+        fire_times.append(t)
+    assert fire_times == expected
+
+
+@pytest.mark.parametrize("expression", EXPRESSIONS)
+def test_between_matches_croniter(expression):
+    schedule = compile_cron(expression)
+    start = datetime(2024, 2, 27, 22, 0)
+    end = start + timedelta(days=3)
+    assert schedule.between(start, end) == list(croniter.croniter_range(start, end, expression))
+
+
+@pytest.mark.parametrize("expression", EXPRESSIONS)
+def test_matches_croniter(expression):
+    # matches() is exact: t is a fire time of croniter. croniter.match() also accepts any second of a
+    # matching minute, so it is not used as the reference.
+    schedule = compile_cron(expression)
+    fire_times = croniter_fire_times(expression, datetime(2024, 1, 1), 10)
+    candidates = fire_times + [fire_time + delta for fire_time in fire_times for delta in (timedelta(seconds=1), timedelta(seconds=59), timedelta(minutes=1), timedelta(hours=1), timedelta(days=1))]
+    for t in candidates:
+        expected = croniter_fire_times(expression, t - timedelta(microseconds=1), 1)[0] == t
+        assert schedule.matches(t) == expected, t
+    assert not schedule.matches(fire_times[0] + timedelta(microseconds=1))
+
+
+@pytest.mark.parametrize("expression", INVALID)
+def test_invalid_expressions_are_rejected(expression):
+    with pytest.raises(ValueError):
+        croniter.croniter(expression, datetime(2024, 1, 1)).get_next(datetime)
+    with pytest.raises(ValueError):
+        compile_cron(expression)
+
+
+@pytest.mark.parametrize("expression", ["0 0 L * *", "0 0 * * 5#2"])
+def test_croniter_extensions_fall_back(expression):
+    schedule = compile_cron(expression)
+    assert isinstance(schedule, CroniterSchedule)
+    start = datetime(2024, 1, 1)
+    assert schedule.next_after(start) == croniter_fire_times(expression, start, 1)[0]
+
+
+def test_never_firing_expression_raises():
+    with pytest.raises(ValueError):
+        CronSchedule("0 0 30 2 *").next_after(datetime(2024, 1, 1))
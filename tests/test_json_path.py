@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from app.json_path import MISSING, compile_key_path, find
+
+# find() must return what walking json.loads(text) along the same key path returns
+DOCUMENTS = [
+    '{"a": 1, "b": "two", "c": null, "d": true, "e": false, "f": -1.5e3}',
+    '{"text": "say \\"hi\\" {not} [an] object", "after": "x\\\\", "last": {"a": "}"}}',
+    '{"quote\\"key": 1, "brace{key}": 2, "next": "\\u007b\\"}", "value": [1, "]", {"x": "["}]}',
+    '{"items": [[1, [2, 3]], [], [[["deep"]]], {"title": "t"}], "n": [0, [1, [2, [3]]]]}',
+    '{"0": "zero", "10": {"2": "two"}, "list": [{"1": "one"}], "x": {"0": [5, 6]}}',
+    '[{"name": "first"}, {"name": "second", "tags": ["a", "b"]}, 3, "four"]',
+    ' \n\t{ "spaced" : { "out" : [ 1 , 2 , { "v" : "w" } ] } , "empty": {}, "none": [] } ',
+    '{"unicode": "caf\\u00e9 \\ud83d\\udd52", "emoji": "⏰", "nested": {"unicode": "\\u00e9"}}',
+]
+
+KEYS = [
+    "a", "b", "c", "d", "e", "f", "g",
+    "text", "after", "last", "last.a",
+    "value", "value.0", "value.1", "value.2.x", "value.3", "next", "brace{key}",
+    "items", "items.0.1.1", "items[2][0][0][0]", "items.3.title", "items.1.0", "items.4", "n.1.1.1.0",
+    "0", "10.2", "list.0.1", "list[0][1]", "x.0.1", "x.0.2", "10.3",
+    "0.name", "[1].tags.1", "2", "3", "3.0", "4", "name",
+    "spaced.out.2.v", "spaced.out.5", "empty", "empty.a", "none", "none.0",
+    "unicode", "emoji", "nested.unicode", "a.b.c",
+]
+
+
+def walk(value, path):
+    for part in path:
+        if isinstance(value, dict) and str(part) in value:
+            value = value[str(part)]
+        elif isinstance(value, list) and isinstance(part, int) and part < len(value):
+            value = value[part]
+        else:
+            return MISSING
+    return value
+
+
+@pytest.mark.parametrize("text", DOCUMENTS)
+@pytest.mark.parametrize("key", KEYS)
+def test_find_matches_json_loads(text, key):
+    path = compile_key_path(key)
+    assert find(text, path) == walk(json.loads(text), path)
+
+
+def test_compile_key_path():
+    assert compile_key_path("items[2].title") == ("items", 2, "title")
+    assert compile_key_path("data.0.name") == ("data", 0, "name")
+    assert compile_key_path("stats.user_count") == ("stats", "user_count")
+
+
+def test_missing_paths():
+    text = '{"a": {"b": [1, 2]}, "c": "d"}'
+    for key in ["x", "a.x", "a.b.2", "a.b.x", "c.0", "a.b.0.c"]:
+        assert find(text, compile_key_path(key)) is MISSING
+
+
+@pytest.mark.parametrize("text", DOCUMENTS)
+def test_truncated_input_raises(text):
+    # Append a last value and cut the text anywhere before that value ends: the walk runs into the end of the text
+    document = json.loads(text)
+    if isinstance(document, dict):
+        text = text.rstrip()[:-1] + ', "end": "value"}'
+        path = compile_key_path("end")
+    else:
+        text = text.rstrip()[:-1] + ', {"end": "value"}]'
+        path = compile_key_path(f"{len(document)}.end")
+    assert find(text, path) == "value"
+    for length in range(text.rindex('"value"') + len('"value"')):
+        with pytest.raises(ValueError):
+            find(text[:length], path)
+
+
+@pytest.mark.parametrize("text", ['', '   ', '{"a": }', '{"a" 1}', '{a: 1}', '{"a": "unterminated}'])
+def test_malformed_input_raises(text):
+    with pytest.raises(ValueError):
+        find(text, compile_key_path("a"))